@@ -0,0 +1,138 @@
+"""
+Space Hunter batch runner.
+
+Plays many independent, seeded, headless games on every core with a multiprocessing pool, for balancing spawn rates,
+alien speeds and player stats.  Each worker process loads the game's assets once, and every game sends back one
+compact record that is aggregated as soon as it arrives.
+
+    python batch.py --games 1000 --set explore_speed=60,75,90 --set respawn_max=1,2 --output runs.csv
+
+"""
+
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import time
+
+import main
+
+def init_worker():
+    # Runs once in every worker process before its first game
+    main.warm_assets()
+
+def play(task):
+    # Play one game and return (config, seed, score, survival time, frames, died)
+    config, seed, tuning, frames = task
+    simulation = main.Simulation(seed=seed, tuning=main.Tuning(**tuning))
+    result = simulation.run(frames, main.random_pilot(seed))
+    return (config, seed, result["score"], result["survival_time"], result["frames"],
+        simulation.game_over)
+
+class Aggregate(object):
+    # Running totals for one configuration, updated one record at a time
+    def __init__(self, tuning):
+        self.tuning = tuning
+        self.games = 0
+        self.deaths = 0
+        self.frames = 0
+        self.score_total = 0
+        self.score_squares = 0
+        self.survival_total = 0.
+
+    def add(self, score, survival_time, frames, died):
+        self.games += 1
+        self.deaths += died
+        self.frames += frames
+        self.score_total += score
+        self.score_squares += score * score
+        self.survival_total += survival_time
+
+    def summary(self):
+        mean = self.score_total / float(self.games)
+        variance = max(0., self.score_squares / float(self.games) - mean * mean)
+        return {"games": self.games, "mean_score": mean, "score_stdev": variance ** 0.5,
+            "mean_survival": self.survival_total / self.games,
+            "death_rate": self.deaths / float(self.games), "frames": self.frames}
+
+def configurations(settings):
+    # Every combination of the --set values, as Tuning keyword dicts
+    names = sorted(settings)
+    for values in itertools.product(*(settings[name] for name in names)):
+        yield dict(zip(names, values))
+
+def tasks(tunings, games, frames, seed):
+    for config, tuning in enumerate(tunings):
+        for game in range(games):
+            yield (config, seed + game, tuning, frames)
+
+def run_batch(tunings, games, frames, processes=None, seed=0, on_record=None):
+    # Play `games` games for every tuning and return one Aggregate per tuning.
+    #   Games with the same index share a seed across tunings, so configs are
+    #   compared on the same alien spawns and pilot inputs.
+    aggregates = [Aggregate(tuning) for tuning in tunings]
+    pool = multiprocessing.Pool(processes, initializer=init_worker)
+    try:
+        for record in pool.imap_unordered(play, tasks(tunings, games, frames, seed), chunksize=8):
+            config, game_seed, score, survival_time, game_frames, died = record
+            aggregates[config].add(score, survival_time, game_frames, died)
+            if on_record is not None:
+                on_record(record)
+    finally:
+        pool.close()
+        pool.join()
+    return aggregates
+
+def parse_setting(text):
+    # "explore_speed=60,75,90" -> ("explore_speed", [60, 75, 90])
+    name, _, values = text.partition("=")
+    if name not in main.Tuning().as_dict():
+        raise argparse.ArgumentTypeError("unknown tuning value %r" % name)
+    parsed = []
+    for value in values.split(","):
+        parsed.append(float(value) if "." in value else int(value))
+    return name, parsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Space Hunter batch runner")
+    parser.add_argument("--games", type=int, default=100, help="games per configuration")
+    parser.add_argument("--frames", type=int, default=9000,
+        help="frame limit per game (default: %(default)s, five minutes at 30 FPS)")
+    parser.add_argument("--processes", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game")
+    parser.add_argument("--set", type=parse_setting, action="append", default=[], metavar="NAME=V1,V2",
+        help="tuning values to try; repeat for more values, every combination is played")
+    parser.add_argument("--output", help="also write every game's record to this CSV file")
+    args = parser.parse_args()
+
+    tunings = list(configurations(dict(args.set)))
+    defaults = main.Tuning().as_dict()
+    tunings = [dict(defaults, **tuning) for tuning in tunings]
+
+    writer = None
+    if args.output:
+        out = open(args.output, "w", newline="")
+        writer = csv.writer(out)
+        writer.writerow(("config", "seed", "score", "survival_time", "frames", "died"))
+
+    started = time.time()
+    aggregates = run_batch(tunings, args.games, args.frames, args.processes, args.seed,
+        writer.writerow if writer is not None else None)
+    elapsed = time.time() - started
+    if writer is not None:
+        out.close()
+
+    varied = [name for name, values in args.set]
+    simulated = 0
+    for config, aggregate in enumerate(aggregates):
+        summary = aggregate.summary()
+        simulated += summary["frames"]
+        label = ", ".join("%s=%s" % (name, aggregate.tuning[name]) for name in varied) or "defaults"
+        print("[%d] %s: score %.1f +/- %.1f, survival %.1f s, death rate %.0f%% over %d games" % (
+            config, label, summary["mean_score"], summary["score_stdev"], summary["mean_survival"],
+            summary["death_rate"] * 100, summary["games"]))
+    print("%d frames simulated in %.1f s (%.0f frames/s)" % (simulated, elapsed, simulated / max(elapsed, 1e-9)))
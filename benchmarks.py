@@ -0,0 +1,209 @@
+"""
+Space Hunter benchmarks.
+
+Times World.process, World.render and the projectile/alien collision pass at growing entity counts with no visible
+window (SDL's dummy video driver), then reports per-frame mean/p95/p99 and how each subsystem scales with entity count.
+The particle system is timed separately with a fixed number of live particles.
+
+Results are written as JSON so a later run can be compared against a stored baseline:
+
+    python benchmarks.py --output baseline.json
+    python benchmarks.py --baseline baseline.json
+
+"""
+
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import time
+
+import pygame
+
+import main
+
+DEFAULT_COUNTS = (10, 100, 1000, 10000)
+DEFAULT_PARTICLES = 50000
+WARM_UP_FRAMES = 5 # Untimed frames at every count before timing starts
+SUBSYSTEMS = ("process", "render", "collisions")
+
+def build_world(count, array_storage=False):
+    # A world with one player plus `count` aliens and `count` projectiles
+    #   spread over the screen.  Returns the world and its projectile pool.
+    random.seed(count)
+    w, h = main.SCREEN_SIZE
+    world = main.World("assets/space_background.png", array_storage=array_storage)
+    player = main.Player(world, main.assets.image("assets/spaceship.png"))
+    player.location = main.vec(w/2, h/2)
+    world.add_entity(player)
+
+    enemy_image = main.assets.image("assets/enemyship.png")
+    for i in range(count):
+        alien = main.Alien(world, enemy_image)
+        world.add_entity(alien)
+        alien.location = main.vec(random.randint(0, w), random.randint(0, h))
+        alien.brain.set_state("exploring")
+        # Exploring starts by heading for a spawn point off the screen; stay on it
+        alien.brain.active_state.random_destination()
+
+    projectiles = main.ProjectilePool(world, main.assets.image("assets/laser.png"), capacity=count)
+    refill(projectiles, random.Random(count))
+    return world, projectiles
+
+def refill(projectiles, rng):
+    # Replace every projectile that left the screen with a new one somewhere
+    #   on it, so each frame has the whole pool in flight
+    w, h = main.SCREEN_SIZE
+    projectiles.despawn_offscreen()
+    while len(projectiles.live) < projectiles.capacity:
+        angle = rng.uniform(0, 2 * math.pi)
+        location = (rng.randint(0, w), rng.randint(0, h))
+        projectiles.fire(location, (math.cos(angle), math.sin(angle)))
+
+def summarize(samples):
+    # Per-frame statistics in milliseconds from nanosecond samples
+    ordered = sorted(samples)
+    def percentile(p):
+        index = min(len(ordered) - 1, int(math.ceil(p / 100. * len(ordered))) - 1)
+        return ordered[max(index, 0)] / 1e6
+    return {"mean_ms": sum(ordered) / len(ordered) / 1e6,
+        "p95_ms": percentile(95), "p99_ms": percentile(99), "frames": len(ordered)}
+
+def scaling_exponent(counts, means):
+    # Least squares slope of log(time) against log(count):
+    #   1.0 is linear, 2.0 quadratic, close to 0 constant
+    points = [(math.log(n), math.log(t)) for n, t in zip(counts, means) if t > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, y in points) / len(points)
+    mean_y = sum(y for x, y in points) / len(points)
+    spread = sum((x - mean_x) ** 2 for x, y in points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / spread
+
+def bench_count(screen, count, frames, array_storage=False):
+    # Time every subsystem for `frames` frames at one entity count, after
+    #   the same untimed warm-up at every count
+    world, projectiles = build_world(count, array_storage)
+    collisions = main.CollisionSystem(world)
+    rng = random.Random(count)
+    samples = dict((name, []) for name in SUBSYSTEMS)
+    clock = time.perf_counter_ns
+
+    for frame in range(WARM_UP_FRAMES + frames):
+        refill(projectiles, rng)
+        start = clock()
+        world.process(main.FIXED_DT)
+        processed = clock()
+        world.render(screen)
+        rendered = clock()
+        collisions.collide("projectile", "alien")
+        collided = clock()
+
+        if frame < WARM_UP_FRAMES:
+            continue
+        samples["process"].append(processed - start)
+        samples["render"].append(rendered - processed)
+        samples["collisions"].append(collided - rendered)
+
+    return dict((name, summarize(values)) for name, values in samples.items())
+
+def bench_particles(screen, count, frames):
+    # Time one update and draw per frame with `count` live particles,
+    #   topping up (untimed) whatever left the screen or burnt out
+    particles = main.ParticleSystem(main.SCREEN_SIZE, capacity=count, seed=count)
+    rng = random.Random(count)
+    w, h = main.SCREEN_SIZE
+    samples = []
+    clock = time.perf_counter_ns
+
+    for frame in range(frames):
+        while particles.count < count:
+            particles.explode((rng.randint(0, w), rng.randint(0, h)), count=1000, life=2.)
+        start = clock()
+        particles.update(main.FIXED_DT / 1000.)
+        particles.draw(screen)
+        samples.append(clock() - start)
+    return summarize(samples)
+
+def run(counts, frames, array_storage=False, particles=0):
+    pygame.init()
+    screen = pygame.display.set_mode(main.SCREEN_SIZE)
+    results = dict((name, {}) for name in SUBSYSTEMS)
+
+    for count in counts:
+        # Keep the largest runs short enough to finish in reasonable time.
+        #   The workload is the same every frame, so fewer frames only make
+        #   the mean noisier, not different.
+        count_frames = max(10, min(frames, frames * 1000 // count))
+        for name, stats in bench_count(screen, count, count_frames, array_storage).items():
+            results[name][str(count)] = stats
+            print("%-10s %6d entities  mean %8.3f ms  p95 %8.3f ms  p99 %8.3f ms" % (
+                name, count, stats["mean_ms"], stats["p95_ms"], stats["p99_ms"]))
+
+    if particles and main.np is None:
+        print("particles  skipped, numpy is not installed")
+    elif particles:
+        stats = bench_particles(screen, particles, frames)
+        results["particles"] = {str(particles): stats}
+        print("%-10s %6d particles mean %8.3f ms  p95 %8.3f ms  p99 %8.3f ms" % (
+            "particles", particles, stats["mean_ms"], stats["p95_ms"], stats["p99_ms"]))
+
+    scaling = {}
+    for name in SUBSYSTEMS:
+        means = [results[name][str(count)]["mean_ms"] for count in counts]
+        scaling[name] = scaling_exponent(counts, means)
+        if scaling[name] is not None:
+            print("%-10s scaling exponent %.2f" % (name, scaling[name]))
+
+    return {"meta": {"python": platform.python_version(), "pygame": pygame.version.ver,
+            "platform": platform.platform(), "array_storage": array_storage,
+            "counts": list(counts), "frames": frames, "particles": particles,
+            "assets": main.assets.report()},
+        "results": results, "scaling": scaling}
+
+def compare(report, baseline, tolerance):
+    # Return a line for every subsystem/count whose mean got slower than the
+    #   baseline by more than `tolerance` (0.2 = 20%)
+    regressions = []
+    for name, by_count in report["results"].items():
+        for count, stats in by_count.items():
+            base = baseline.get("results", {}).get(name, {}).get(count)
+            if base is None or base["mean_ms"] <= 0:
+                continue
+            ratio = stats["mean_ms"] / base["mean_ms"]
+            if ratio > 1 + tolerance:
+                regressions.append("%s at %s entities: %.3f ms vs %.3f ms baseline (x%.2f)" % (
+                    name, count, stats["mean_ms"], base["mean_ms"], ratio))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Space Hunter benchmarks")
+    parser.add_argument("--counts", type=int, nargs="+", default=list(DEFAULT_COUNTS),
+        help="alien and projectile counts to time (default: %(default)s)")
+    parser.add_argument("--frames", type=int, default=60, help="frames timed at 1000 entities or fewer")
+    parser.add_argument("--array-storage", action="store_true", help="use the NumPy entity store")
+    parser.add_argument("--particles", type=int, default=DEFAULT_PARTICLES,
+        help="live particles to time the particle system with, 0 to skip (default: %(default)s)")
+    parser.add_argument("--output", default="bench_results.json", help="where to write the results")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+        help="allowed slowdown against the baseline before failing (default: %(default)s)")
+    args = parser.parse_args()
+
+    report = run(args.counts, args.frames, args.array_storage, args.particles)
+    with open(args.output, "w") as results_file:
+        json.dump(report, results_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.tolerance)
+        for line in regressions:
+            print("REGRESSION " + line)
+        if regressions:
+            sys.exit(1)
@@ -16,9 +16,25 @@ import pygame
 import pygame.mask
 from pygame.locals import *
 import sys
+import argparse
+import atexit
+import csv
+import heapq
+import queue
+import json
 import math
 import random
+import struct
+import threading
 import time
+from array import array
+from collections import Counter, OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is only needed for the optional array-backed entity storage
+    np = None
 
 vec = pygame.math.Vector2
 randint = random.randint
@@ -26,6 +42,30 @@ randint = random.randint
 SCREEN_SIZE = (1200, 800)
 START_POSITION = (300, 400)
 START_SIZE = 10.
+ROTATION_STEP = 2 # Degrees between the pre-rendered rotations of a sprite
+MAX_PROJECTILES = 256 # Projectiles that can be in flight at once
+ATTACK_RANGE = 15 # Distance within which a hunting alien can hurt its player
+FIXED_DT = 1000. / 30 # Milliseconds per step for headless and fixed step simulations
+FIXED_STEP = False # Step the game at FIXED_DT and interpolate drawing between steps
+RENDER_FPS = 30 # Frame cap of the game in fixed step mode (0 = uncapped)
+MAX_STEPS_PER_FRAME = 5 # Steps a slow frame may catch up on before time is dropped
+PIPELINE = False # Simulate on a thread of its own while the main thread draws
+DIRTY_RECTS = False # Only redraw and push the parts of the screen that changed
+DIRTY_THRESHOLD = 0.5 # Fraction of the screen past which a full redraw is cheaper
+TEXT_CACHE_SIZE = 256 # Rendered text surfaces kept before the oldest is dropped
+MAX_STARS = 250 # Stars on the title screen
+GAME_STARS = 0 # Stars drawn over the in-game background (0 = none)
+PARTICLES = True # Explosion and thruster particles in the game (needs numpy)
+MAX_PARTICLES = 65536 # Particles alive at once; emitting past this drops the extra
+PROFILE_FRAMES = 900 # Frames kept by the frame profiler's ring buffer
+RECORD_PATH = None # Record the game's input to this file (see InputRecorder)
+# (distance to the nearest player, think every Nth frame) for alien brains
+AI_BANDS = ((300., 1), (600., 4), (float("inf"), 8))
+# (path, has alpha) of every image a game needs, decoded while the intro shows
+GAME_IMAGES = (("assets/space_background.png", False), ("assets/spaceship.png", True),
+    ("assets/enemyship.png", True), ("assets/laser.png", True), ("assets/explosion.png", True))
+STARTUP_BUDGET = 1500. # Milliseconds from launch to the first frame of gameplay
+WARM_UP_SLICE = 15. # Milliseconds of asset warm-up done per intro frame
 black = (0, 0, 0)
 white = (255,255,255)
 grey = (200,200,200)
@@ -81,81 +121,1071 @@ class StateMachine(object):
         self.active_state = self.states[new_state_name]
         self.active_state.entry_actions()
 
+class SpatialGrid(object):
+    # Uniform grid that buckets entities by the cell their location falls in.
+    #   Entities are indexed per name, so a query for "player" never has to
+    #   look at the aliens sharing the same cells.
+    def __init__(self, cell_size=100.):
+        self.cell_size = float(cell_size)
+        self.cells = {} # name -> {(cx, cy): {entity_id: entity}}
+        self.entity_cells = {} # entity_id -> (name, (cx, cy))
+        self.extents = {} # name -> largest half-diagonal of any sprite seen
+
+    def cell_for(self, location):
+        # Return the integer cell coordinates holding a location
+        return (int(math.floor(location[0] / self.cell_size)),
+                int(math.floor(location[1] / self.cell_size)))
+
+    def insert(self, entity):
+        # Add an entity to the cell matching its current location
+        if entity.id in self.entity_cells:
+            self.remove(entity)
+        cell = self.cell_for(entity.location)
+        buckets = self.cells.setdefault(entity.name, {})
+        buckets.setdefault(cell, {})[entity.id] = entity
+        self.entity_cells[entity.id] = (entity.name, cell)
+        # Half of the image diagonal bounds the sprite at any rotation
+        w, h = entity.image.get_size()
+        extent = math.hypot(w, h) / 2
+        if extent > self.extents.get(entity.name, 0):
+            self.extents[entity.name] = extent
+
+    def remove(self, entity):
+        # Drop an entity from whichever cell it was last seen in
+        entry = self.entity_cells.pop(entity.id, None)
+        if entry is None:
+            return
+        name, cell = entry
+        buckets = self.cells[name]
+        bucket = buckets[cell]
+        bucket.pop(entity.id, None)
+        if not bucket:
+            del buckets[cell]
+
+    def update(self, entity):
+        # Move an entity to a new cell, only touching the index if it crossed
+        #   a cell border since the last update
+        entry = self.entity_cells.get(entity.id)
+        if entry is None:
+            self.insert(entity)
+            return
+        cell = self.cell_for(entity.location)
+        if cell != entry[1]:
+            self.remove(entity)
+            self.insert(entity)
+
+    def clear(self):
+        # Forget every indexed entity
+        self.cells.clear()
+        self.entity_cells.clear()
+        self.extents.clear()
+
+    def entities_named(self, name):
+        # Yield every indexed entity with the given name
+        for bucket in self.cells.get(name, {}).values():
+            yield from bucket.values()
+
+    def query(self, name, location, radius):
+        # Yield every entity with a matching name in the cells overlapping
+        #   the square around location.  Callers still need a distance check.
+        buckets = self.cells.get(name)
+        if not buckets:
+            return
+        min_x, min_y = self.cell_for((location[0] - radius, location[1] - radius))
+        max_x, max_y = self.cell_for((location[0] + radius, location[1] + radius))
+        # Few occupied cells (e.g. a single player): walk the occupied cells
+        #   instead of every cell in the query square
+        if len(buckets) < (max_x - min_x + 1) * (max_y - min_y + 1):
+            for (cx, cy), bucket in buckets.items():
+                if min_x <= cx <= max_x and min_y <= cy <= max_y:
+                    yield from bucket.values()
+            return
+        for cx in range(min_x, max_x + 1):
+            for cy in range(min_y, max_y + 1):
+                bucket = buckets.get((cx, cy))
+                if bucket:
+                    yield from bucket.values()
+
+class CollisionSystem(object):
+    # Finds overlapping pairs between two groups of entities (by name).
+    #   Broadphase: the world's spatial grid only hands back entities whose
+    #   centers are close enough for their bounding boxes to touch.
+    #   Narrowphase: pixel masks are only compared for pairs whose rects overlap.
+    def __init__(self, world):
+        self.world = world
+        self.broadphase_pairs = 0 # Candidate pairs found by the grid last call
+        self.narrowphase_tests = 0 # Mask comparisons made last call
+
+    def entity_rect(self, entity):
+        # Rect of the entity's collision mask, centered on its location
+        w, h = entity.mask.get_size()
+        return pygame.Rect(int(entity.location.x - w/2),
+            int(entity.location.y - h/2), w, h)
+
+    def collide(self, name_a, name_b):
+        # Return a list of (a, b) pairs where an entity named name_a overlaps
+        #   an entity named name_b.  Put the smaller group first.
+        grid = self.world.grid
+        reach_b = grid.extents.get(name_b, 0)
+        self.broadphase_pairs = 0
+        self.narrowphase_tests = 0
+        hits = []
+
+        for a in list(grid.entities_named(name_a)):
+            rect_a = self.entity_rect(a)
+            reach = grid.extents.get(name_a, 0) + reach_b
+            for b in grid.query(name_b, a.location, reach):
+                if b is a:
+                    continue
+                self.broadphase_pairs += 1
+                rect_b = self.entity_rect(b)
+                if not rect_a.colliderect(rect_b):
+                    continue
+                self.narrowphase_tests += 1
+                offset = (rect_b.x - rect_a.x, rect_b.y - rect_a.y)
+                if a.mask.overlap(b.mask, offset):
+                    hits.append((a, b))
+        return hits
+
+    def within(self, name_a, name_b, distance):
+        # Return a list of (a, b) pairs whose centers are closer than
+        #   distance: the same broadphase, with a distance narrowphase
+        grid = self.world.grid
+        self.broadphase_pairs = 0
+        self.narrowphase_tests = 0
+        hits = []
+
+        for a in list(grid.entities_named(name_a)):
+            location = a.location
+            for b in grid.query(name_b, location, distance):
+                if b is a:
+                    continue
+                self.broadphase_pairs += 1
+                self.narrowphase_tests += 1
+                if location.distance_to(b.location) < distance:
+                    hits.append((a, b))
+        return hits
+
+class EntityStore(object):
+    # Struct-of-arrays storage for moving entities.  Each attached entity owns
+    #   one row of the arrays, and its location/destination/direction/speed
+    #   attributes read and write that row.  Movement for every row is then
+    #   integrated in a single vectorized step per frame.
+    def __init__(self, capacity=1024):
+        if np is None:
+            raise ImportError("Array-backed entity storage requires numpy")
+        self.location = np.zeros((capacity, 2))
+        self.destination = np.zeros((capacity, 2))
+        self.direction = np.zeros((capacity, 2))
+        self.speed = np.zeros(capacity)
+        self.ballistic = np.zeros(capacity, dtype=bool) # Projectile rows
+        self.active = np.zeros(capacity, dtype=bool)
+        self.cells = np.zeros((capacity, 2), dtype=np.int64) # Last grid cell
+        self.entities = [None] * capacity # row -> entity
+        self.free_rows = list(range(capacity - 1, -1, -1))
+        self.used = 0 # One past the highest row ever handed out
+
+    def grow(self):
+        # Double the capacity of every array
+        old = len(self.speed)
+        for field in ("location", "destination", "direction", "speed",
+                "ballistic", "active", "cells"):
+            array = getattr(self, field)
+            grown = np.zeros((old * 2,) + array.shape[1:], dtype=array.dtype)
+            grown[:old] = array
+            setattr(self, field, grown)
+        self.entities.extend([None] * old)
+        self.free_rows.extend(range(old * 2 - 1, old - 1, -1))
+
+    def attach(self, entity):
+        # Move an entity's movement state into a free row
+        if not self.free_rows:
+            self.grow()
+        row = self.free_rows.pop()
+        self.used = max(self.used, row + 1)
+        self.location[row] = entity._location
+        self.destination[row] = entity._destination
+        self.direction[row] = getattr(entity, "_direction", (0, 0))
+        self.speed[row] = entity._speed
+        self.ballistic[row] = entity.motion == "ballistic"
+        self.active[row] = True
+        # Force a grid update on the first integration step
+        self.cells[row] = np.iinfo(np.int64).min
+        self.entities[row] = entity
+        entity.store = self
+        entity.row = row
+
+    def detach(self, entity):
+        # Copy the row back onto the entity and free the row
+        row = entity.row
+        entity.row = None
+        entity.store = None
+        entity._location = vec(*self.location[row])
+        entity._destination = vec(*self.destination[row])
+        if entity.motion == "ballistic":
+            entity._direction = vec(*self.direction[row])
+        entity._speed = float(self.speed[row])
+        self.active[row] = False
+        self.speed[row] = 0
+        self.entities[row] = None
+        self.free_rows.append(row)
+
+    def integrate(self, time_passed):
+        # Advance every active row: seekers move towards their destination
+        #   (never overshooting it), projectiles move along their direction
+        n = self.used
+        location = self.location[:n]
+        speed = self.speed[:n]
+        active = self.active[:n]
+        ballistic = self.ballistic[:n]
+
+        to_destination = self.destination[:n] - location
+        distance = np.hypot(to_destination[:, 0], to_destination[:, 1])
+        seeking = active & ~ballistic & (speed > 0) & (distance > 0)
+        travel = np.minimum(distance, speed * time_passed)
+        scale = np.divide(travel, distance, out=np.zeros(n), where=seeking)
+        location += to_destination * scale[:, None]
+
+        flying = active & ballistic
+        location += self.direction[:n] * (speed * time_passed * flying)[:, None]
+
+    def moved(self, cell_size):
+        # Return the entities whose grid cell changed since the last call
+        n = self.used
+        cells = np.floor(self.location[:n] / cell_size).astype(np.int64)
+        changed = self.active[:n] & (cells != self.cells[:n]).any(axis=1)
+        rows = np.flatnonzero(changed)
+        self.cells[rows] = cells[rows]
+        return [self.entities[row] for row in rows]
+
+class AIScheduler(object):
+    # Decides which brains think this frame.  Entities close to a player think
+    #   every frame and far away ones every few frames (see AI_BANDS).  An
+    #   entity's turn is offset by its id, so the far ones are spread evenly
+    #   over the frames instead of all thinking on the same one.  The band is
+    #   only re-measured on an entity's turn, so skipping costs no distance.
+    def __init__(self, bands=AI_BANDS, focus="player"):
+        self.bands = bands
+        self.focus = focus # Name of the entities distance is measured to
+        self.frame = 0
+        self.focus_locations = []
+        self.thought = 0 # Brains run last frame
+        self.skipped = 0 # Brains skipped last frame
+
+    def begin_frame(self, world):
+        self.frame += 1
+        self.thought = 0
+        self.skipped = 0
+        self.focus_locations = [vec(entity.location)
+            for entity in world.grid.entities_named(self.focus)]
+
+    def period_for(self, entity):
+        # Think interval for the band the entity is in right now
+        if not self.focus_locations:
+            return self.bands[-1][1]
+        location = entity.location
+        distance = min(location.distance_to(focus) for focus in self.focus_locations)
+        for limit, period in self.bands:
+            if distance < limit:
+                return period
+        return self.bands[-1][1]
+
+    def due(self, entity):
+        # True if the entity's brain should run this frame
+        if (self.frame + (entity.id & HANDLE_INDEX_MASK)) % entity.ai_period:
+            self.skipped += 1
+            return False
+        entity.ai_period = self.period_for(entity)
+        self.thought += 1
+        return True
+
+class Tuning(object):
+    # The gameplay numbers that balancing runs vary.  Every World has one and
+    #   the alien states and Simulation read their numbers from it.
+    def __init__(self, alien_count=30, respawn_min=0, respawn_max=2,
+            explore_speed=75., hunt_speed=None, player_health=100, player_max_speed=300,
+            mask_contacts=0):
+        self.alien_count = alien_count # Aliens at the start of a game
+        self.respawn_min = respawn_min # Aliens spawned per kill, picked
+        self.respawn_max = respawn_max #   uniformly between min and max
+        self.explore_speed = explore_speed
+        # Hunting speed, plus up to 50 at random (None = keep exploring speed)
+        self.hunt_speed = hunt_speed
+        self.player_health = player_health
+        self.player_max_speed = player_max_speed
+        # 1 = hunters reach their player when their masks overlap, using the
+        #   player's rotated mask, instead of within ATTACK_RANGE
+        self.mask_contacts = mask_contacts
+
+    def as_dict(self):
+        return dict(vars(self))
+
+# World snapshots: a header, then one fixed-size record per entity.  Surfaces,
+#   masks and brains are not stored; restore() rebuilds them from shared assets.
+SNAPSHOT_HEADER = struct.Struct("<4sBIII") # magic, version, entity count, slot count,
+    # AI scheduler frame; the records are followed by one u16 generation per slot
+SNAPSHOT_ENTITY = struct.Struct("<BI7dhdBBi") # type, id, location, destination,
+    # direction, speed, health, rotation, brain state, AI period,
+    # hunted player id (-1 = none)
+SNAPSHOT_MAGIC = b"SHWS"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_TYPES = ("player", "alien", "projectile") # Entity names by type code - 1
+SNAPSHOT_STATES = ("exploring", "hunting") # Brain states by state code - 1
+
+# Entity handles: the low bits index a slot that is reused once its entity
+#   is removed, the high bits count how many times the slot has been reused,
+#   so a handle kept after its entity is gone never finds the slot's new one.
+HANDLE_INDEX_BITS = 20
+HANDLE_INDEX_MASK = (1 << HANDLE_INDEX_BITS) - 1
+HANDLE_GENERATIONS = 1 << 11 # Keeps handles below 2**31
+
 class World(object):
     # Class to store the positions of all entities in map
     #   This object will help one entity determine attributes about other entites.
-    def __init__(self, background):
-        self.entities = {} # Store all of the entities
-        self.entity_id = 0 # Last entity ID assignment
-        self.background_size = pygame.surface.Surface(SCREEN_SIZE).convert()
-        self.background = pygame.image.load(background).convert()
-
-    def add_entity(self, entity):
-        # Adds an entity to the world and stores an ID for it
-        self.entities[self.entity_id] = entity
-        entity.id = self.entity_id
-        self.entity_id += 1
+    def __init__(self, background=None, cell_size=100., array_storage=False,
+            ai_bands=AI_BANDS, tuning=None):
+        self.entities = {} # Store all of the entities, by handle
+        self.generations = [] # Current generation of every slot
+        self.free_slots = [] # Heap of unused slots, lowest first
+        # Spawns and despawns waiting for the next sync()
+        self.commands = []
+        # Headless worlds have no background and are never rendered
+        self.background = None
+        if background is not None:
+            self.background = assets.image(background, alpha=False)
+        self.grid = SpatialGrid(cell_size) # Spatial index for range queries
+        # Optional NumPy rows for entity movement (None = per-object vectors)
+        self.store = EntityStore() if array_storage else None
+        # Dirty-rect rendering: where each entity was drawn last frame (None
+        #   forces a full redraw), where the particles were drawn, and extra
+        #   regions to restore next frame
+        self.drawn_rects = None
+        self.particle_rect = None
+        self.invalidated = []
+        # Interpolated rendering: (x, y, rotation) of every entity before the
+        #   last step, and the poses to draw them in while interpolate() is in
+        #   effect (entities themselves are never moved for drawing)
+        self.previous = {}
+        self.poses = {}
+        self.starfield = None # Optional Starfield drawn over the background
+        self.particles = None # Optional ParticleSystem, moved with the world
+        # Level-of-detail scheduling for brains (None = every brain every frame)
+        self.scheduler = AIScheduler(ai_bands) if ai_bands else None
+        self.tuning = tuning if tuning is not None else Tuning()
+
+    def allocate(self):
+        # Reserve a slot and return the handle for it
+        if self.free_slots:
+            index = heapq.heappop(self.free_slots)
+        else:
+            index = len(self.generations)
+            if index > HANDLE_INDEX_MASK:
+                raise OverflowError("World is full (%d entities)" % index)
+            self.generations.append(0)
+        return self.generations[index] << HANDLE_INDEX_BITS | index
+
+    def release(self, handle):
+        # Retire a handle and make its slot reusable
+        index = handle & HANDLE_INDEX_MASK
+        self.generations[index] = (self.generations[index] + 1) % HANDLE_GENERATIONS
+        heapq.heappush(self.free_slots, index)
+
+    def add_entity(self, entity, entity_id=None):
+        # Adds an entity to the world straight away.  Entities added while
+        #   the world is being processed must use spawn() instead.  restore()
+        #   and sync() pass the handle the entity already has.
+        if entity_id is None:
+            entity_id = self.allocate()
+        self.entities[entity_id] = entity
+        entity.id = entity_id
+        if self.store is not None and entity.motion is not None:
+            if entity.row is not None:
+                entity.store.detach(entity)
+            self.store.attach(entity)
+        self.grid.insert(entity)
 
     def remove_entity(self, entity):
-        # Remove an entity from the world
+        # Remove an entity from the world straight away (see despawn()) and
+        #   retire its handle
         del self.entities[entity.id]
+        if entity.row is not None:
+            entity.store.detach(entity)
+        self.grid.remove(entity)
+        self.release(entity.id)
+
+    def spawn(self, entity):
+        # Add an entity at the next sync().  Its handle is valid right away,
+        #   but get() only finds it once it has joined the world.
+        entity.id = self.allocate()
+        self.commands.append((True, entity))
+        return entity.id
+
+    def despawn(self, entity):
+        # Remove an entity at the next sync(); despawning twice is harmless
+        self.commands.append((False, entity))
+
+    def sync(self):
+        # Apply queued spawns and despawns in the order they were made.  The
+        #   world calls this at the end of process(), and Simulation at the
+        #   end of every step.
+        commands = self.commands
+        self.commands = []
+        for adding, entity in commands:
+            if adding:
+                self.add_entity(entity, entity.id)
+            elif self.entities.get(entity.id) is entity:
+                self.remove_entity(entity)
+
+    def clear(self):
+        # Remove every entity and start handing out slots from 0 again.
+        #   Generations carry on, so handles from before still find nothing.
+        for entity in list(self.entities.values()):
+            self.remove_entity(entity)
+        for adding, entity in self.commands:
+            if adding:
+                self.release(entity.id)
+        self.commands = []
+        self.grid.clear()
+        self.drawn_rects = None
+        self.particle_rect = None
+        self.invalidated = []
+        self.previous = {}
+        self.poses = {}
+        if self.particles is not None:
+            self.particles.count = 0
+        if self.scheduler is not None:
+            self.scheduler.frame = 0
+
+    def snapshot(self):
+        # Pack every entity's state into one flat buffer.  Snapshots are
+        #   taken at a sync point, so queued commands are applied first.
+        self.sync()
+        entities = list(self.entities.values())
+        size = SNAPSHOT_ENTITY.size
+        slots = len(self.generations)
+        buffer = bytearray(SNAPSHOT_HEADER.size + size * len(entities) + 2 * slots)
+        scheduler_frame = self.scheduler.frame if self.scheduler is not None else 0
+        SNAPSHOT_HEADER.pack_into(buffer, 0, SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+            len(entities), slots, scheduler_frame)
+        type_codes = dict((name, i + 1) for i, name in enumerate(SNAPSHOT_TYPES))
+        state_codes = dict((name, i + 1) for i, name in enumerate(SNAPSHOT_STATES))
+        pack_into = SNAPSHOT_ENTITY.pack_into
+
+        offset = SNAPSHOT_HEADER.size
+        for entity in entities:
+            location = entity.location
+            destination = entity.destination
+            direction = getattr(entity, "direction", None) if entity.motion == "ballistic" else None
+            if direction is None:
+                direction = (0, 0)
+            state = entity.brain.active_state
+            pack_into(buffer, offset, type_codes[entity.name], entity.id,
+                location[0], location[1], destination[0], destination[1],
+                direction[0], direction[1], entity.speed,
+                getattr(entity, "health", 0), getattr(entity, "rotation", 0),
+                state_codes[state.name] if state is not None else 0,
+                entity.ai_period, getattr(entity, "player_id", -1))
+            offset += size
+        struct.pack_into("<%dH" % slots, buffer, offset, *self.generations)
+        return bytes(buffer)
+
+    def restore(self, data, factory):
+        # Replace every entity with the ones in a snapshot.  factory(name)
+        #   returns a new entity of that name with its image and brain set up.
+        magic, version, count, slots, scheduler_frame = SNAPSHOT_HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("Not a Space Hunter world snapshot (version %d)" % SNAPSHOT_VERSION)
+        self.clear()
+        end = SNAPSHOT_HEADER.size + SNAPSHOT_ENTITY.size * count
+        # Every slot the snapshot's entities don't use is free
+        self.generations = list(struct.unpack_from("<%dH" % slots, data, end))
+        used = set()
+
+        for record in SNAPSHOT_ENTITY.iter_unpack(data[SNAPSHOT_HEADER.size:end]):
+            (type_code, entity_id, x, y, dest_x, dest_y, dir_x, dir_y, speed,
+                health, rotation, state_code, ai_period, player_id) = record
+            entity = factory(SNAPSHOT_TYPES[type_code - 1])
+            entity.location = vec(x, y)
+            entity.destination = vec(dest_x, dest_y)
+            if entity.motion == "ballistic":
+                entity.direction = vec(dir_x, dir_y)
+            entity.speed = speed
+            if hasattr(entity, "health"):
+                entity.health = health
+            if hasattr(entity, "rotation"):
+                entity.rotation = rotation
+            entity.ai_period = ai_period
+            if player_id >= 0:
+                entity.player_id = player_id
+            if state_code:
+                # Resume the state as it was, without its entry actions
+                entity.brain.active_state = entity.brain.states[SNAPSHOT_STATES[state_code - 1]]
+            self.add_entity(entity, entity_id)
+            used.add(entity_id & HANDLE_INDEX_MASK)
+        self.free_slots = [index for index in range(slots) if index not in used]
+        heapq.heapify(self.free_slots)
+        if self.scheduler is not None:
+            self.scheduler.frame = scheduler_frame
 
     def get(self, entity_id):
-        # Find the entity, given its ID (or None if no ID is found)
-        if entity_id in self.entities:
-            return self.entities[entity_id]
-        else:
-            return None
+        # Find the entity, given its handle (or None if the entity is gone,
+        #   even when its slot now holds another one)
+        return self.entities.get(entity_id)
 
     def process(self, time_passed):
         # Process every entity in the world
         time_passed_seconds = time_passed / 1000.0
-        for entity in self.entities.copy().values():
-            entity.process(time_passed_seconds)
+        scheduler = self.scheduler
+        if scheduler is not None:
+            scheduler.begin_frame(self)
 
-    def render(self, surface):
-        # Draw the background and all the entities
-        surface.blit(self.background, (0, 0))
+        # Brains spawn and despawn through the command buffer, so the
+        #   entities can't change while they are iterated
         for entity in self.entities.values():
-            entity.render(surface)
+            # Brains may be skipped this frame, movement never is
+            if scheduler is None or scheduler.due(entity):
+                entity.think()
+            if entity.row is None:
+                entity.integrate(time_passed_seconds)
+                self.grid.update(entity)
+            # Array-backed entities are moved together below
+
+        if self.store is not None:
+            self.store.integrate(time_passed_seconds)
+            for entity in self.store.moved(self.grid.cell_size):
+                self.grid.update(entity)
+        self.sync()
+        if self.particles is not None:
+            self.particles.update(time_passed_seconds)
 
-    def get_close_entity(self, name, location, range=100.):
-        # Find an entity within range of a location
+    def render(self, surface):
+        # Draw the background and all the entities
+        if self.background is not None:
+            surface.blit(self.background, (0, 0))
+        if self.starfield is not None:
+            self.starfield.update()
+            self.starfield.draw(surface)
+        self.draw_entities(surface, self.entities.values())
+        if self.particles is not None:
+            self.particles.draw(surface)
+
+    def draw_entities(self, surface, entities):
+        # Draw the entities layer by layer in a single blits() call, and the
+        #   overlays on top
+        sequence, fills = self.sprites(entities, surface.get_size())
+        surface.blits(sequence, False)
+        for color, rect in fills:
+            surface.fill(color, rect)
+
+    def sprites(self, entities, size):
+        # Skip entities entirely off a surface of this size, and return the
+        #   (surface, position) blits of the rest sorted by layer, with the
+        #   (color, rect) fills of their overlays
+        width, height = size
+        visible = pygame.Rect((0, 0), size)
+        layers = {}
+        fills = []
+        poses = self.poses
+        for entity in entities:
+            pose = poses.get(entity.id) if poses else None
+            image, (x, y) = entity.sprite(pose)
+            if pose is None:
+                half_w, half_h = entity.extent
+            else:
+                # A rotated pose can be a different size
+                half_w, half_h = image.get_width() / 2., image.get_height() / 2.
+            if x < width and y < height and x + 2 * half_w > 0 and y + 2 * half_h > 0:
+                layers.setdefault(entity.layer, []).append((image, (x, y)))
+            if entity.overlay:
+                # fill() shifts a rect hanging off the top left edge instead
+                #   of clipping it
+                for color, rect in entity.overlay_fills(pose):
+                    fills.append((color, visible.clip(rect)))
+
+        if len(layers) == 1:
+            sequence = layers.popitem()[1]
+        else:
+            sequence = []
+            for layer in sorted(layers):
+                sequence += layers[layer]
+        return sequence, fills
+
+    def render_frame(self, surface, frame):
+        # Draw a RenderFrame published by a SimulationPipeline.  The
+        #   background and stars belong to the drawing thread, everything
+        #   else comes from the frame.
+        if self.background is not None:
+            surface.blit(self.background, (0, 0))
+        if self.starfield is not None:
+            self.starfield.update()
+            self.starfield.draw(surface)
+        surface.blits(frame.sprites, False)
+        if frame.particles is not None:
+            self.particles.draw_snapshot(surface, frame.particles)
+        for color, rect in frame.fills:
+            surface.fill(color, rect)
+
+    def remember(self):
+        # Keep where every entity is before the next step, to draw in between
+        previous = {}
+        for entity_id, entity in self.entities.items():
+            x, y = entity.location
+            previous[entity_id] = (x, y, getattr(entity, "rotation", None))
+        self.previous = previous
+
+    def interpolate(self, alpha):
+        # Have render() and render_dirty() draw every entity `alpha` (0 to 1)
+        #   of the way from where it was before the last step to where it is
+        #   now.  Only the drawing poses change, never the entities, so the
+        #   simulation can't be affected.  end_interpolation() goes back to
+        #   drawing entities where they are.
+        alpha = min(alpha, 1.) # Time runs on when stepping stops
+        poses = {}
+        previous = self.previous
+        for entity_id, entity in self.entities.items():
+            old = previous.get(entity_id)
+            if old is None:
+                # New since the last step, draw it where it is
+                continue
+            x, y = entity.location
+            rotation = getattr(entity, "rotation", None)
+            if rotation is not None and old[2] is not None:
+                rotation = old[2] + (rotation - old[2]) * alpha
+            poses[entity_id] = (old[0] + (x - old[0]) * alpha, old[1] + (y - old[1]) * alpha, rotation)
+        self.poses = poses
+
+    def end_interpolation(self):
+        self.poses = {}
+
+    def invalidate(self, rect=None):
+        # Have render_dirty restore a region next frame, or the whole screen
+        #   when no rect is given
+        if rect is None:
+            self.drawn_rects = None
+        else:
+            self.invalidated.append(pygame.Rect(rect))
+
+    def render_dirty(self, surface, threshold=DIRTY_THRESHOLD):
+        # Redraw only what changed since the last call and return the rects
+        #   that need to be passed to pygame.display.update
+        current = {}
+        poses = self.poses
+        for entity_id, entity in self.entities.items():
+            current[entity_id] = entity.bounds(poses.get(entity_id))
+
+        previous = self.drawn_rects
+        self.drawn_rects = current
+        previous_particles = self.particle_rect
+        self.particle_rect = self.particles.bounds() if self.particles is not None else None
+        screen_rect = surface.get_rect()
+        # Moving stars can cover the whole screen, so there is nothing to save
+        if previous is None or self.starfield is not None:
+            self.invalidated = []
+            self.render(surface)
+            return [screen_rect]
+
+        # Old and new rects of everything that moved, appeared or vanished.
+        #   Particles move every frame, so the area they covered last frame
+        #   and the area they cover now are always restored.
+        dirty = self.invalidated
+        self.invalidated = []
+        for rect in (previous_particles, self.particle_rect):
+            if rect is not None:
+                dirty.append(rect)
+        redraw = set()
+        entities = self.entities
+        for entity_id, rect in current.items():
+            old = previous.get(entity_id)
+            # Turning on the spot keeps the bounds but not the sprite
+            if old == rect and not entities[entity_id].turns:
+                continue
+            redraw.add(entity_id)
+            if old is None:
+                dirty.append(rect)
+                continue
+            # A small move is cheaper to restore as one rect covering both
+            moved = rect.union(old)
+            if moved.width * moved.height <= 2 * rect.width * rect.height:
+                dirty.append(moved)
+            else:
+                dirty.append(old)
+                dirty.append(rect)
+        for entity_id, old in previous.items():
+            if entity_id not in current:
+                dirty.append(old)
+
+        # Entities touching a restored region get redrawn whole, so their
+        #   full rect has to be restored too
+        grew = True
+        while grew:
+            grew = False
+            for entity_id, rect in current.items():
+                if entity_id not in redraw and rect.collidelist(dirty) != -1:
+                    redraw.add(entity_id)
+                    dirty.append(rect)
+                    grew = True
+
+        dirty = [rect.clip(screen_rect) for rect in dirty]
+        dirty = [rect for rect in dirty if rect.width and rect.height]
+        area = sum(rect.width * rect.height for rect in dirty)
+        if area > threshold * screen_rect.width * screen_rect.height:
+            self.render(surface)
+            return [screen_rect]
+
+        surface.blits([(self.background, rect, rect) for rect in dirty], False)
+        self.draw_entities(surface, [entity for entity_id, entity in self.entities.items()
+            if entity_id in redraw])
+        if self.particle_rect is not None:
+            self.particles.draw(surface)
+        return dirty
+
+    def get_close_entity(self, name, location, range=100., living=False):
+        # Find the closest entity within range of a location (only ones with
+        #   health left when living is set), only looking at the grid cells
+        #   the range can reach
         location = vec(*location)
 
-        for entity in self.entities.values():
-            if entity.name == name:
-                distance = location.distance_to(entity.location)
-                if distance < range:
-                    return entity
-        return None
+        closest = None
+        for entity in self.grid.query(name, location, range):
+            if living and entity.health <= 0:
+                continue
+            distance = location.distance_to(entity.location)
+            if distance < range:
+                closest = entity
+                range = distance
+        return closest
+
+class RotationAtlas(object):
+    # Pre-renders an image at every multiple of a fixed angle step, together
+    #   with a collision mask matching that rotation and the offset from the
+    #   entity's location to the top left of the rotated surface.
+    def __init__(self, image, step=ROTATION_STEP):
+        self.step = step
+        self.count = int(round(360. / step))
+        self.frames = []
+        for i in range(self.count):
+            rotated = pygame.transform.rotate(image, i * step)
+            w, h = rotated.get_size()
+            mask = pygame.mask.from_surface(rotated)
+            self.frames.append((rotated, mask, (-w/2, -h/2)))
+
+    def get(self, angle):
+        # Return (surface, mask, offset) for the nearest pre-rendered angle
+        return self.frames[int(round(angle / self.step)) % self.count]
+
+class AssetRegistry(object):
+    # Loads, converts and masks each asset only once.  Every entity using an
+    #   image gets the same surface, mask and rotation atlas objects, so they
+    #   must be treated as read-only.
+    def __init__(self):
+        self.images = {} # (path, alpha) -> surface
+        self.masks = {} # id(surface) -> (surface, mask)
+        self.atlases = {} # (id(surface), step) -> (surface, atlas)
+        self.extents = {} # id(surface) -> (surface, (half width, half height))
+        self.decoding = {} # (path, alpha) -> event set once the preload thread is done with it
+        self.decoded = {} # (path, alpha) -> surface decoded by the preload thread
+        # Per kind of asset: [hits, misses, bytes held]
+        self.counters = {"image": [0, 0, 0], "mask": [0, 0, 0], "atlas": [0, 0, 0]}
+
+    def count(self, kind, hit, size=0):
+        counter = self.counters[kind]
+        counter[0 if hit else 1] += 1
+        counter[2] += size
+
+    def surface_bytes(self, surface):
+        w, h = surface.get_size()
+        return w * h * surface.get_bytesize()
+
+    def mask_bytes(self, mask):
+        w, h = mask.get_size()
+        return (w * h + 7) // 8
+
+    def image(self, path, alpha=True):
+        # Load an image file, converted to the display format when a display
+        #  exists (headless runs keep the decoded surface as it is)
+        key = (path, alpha)
+        surface = self.images.get(key)
+        if surface is not None:
+            self.count("image", True)
+            return surface
+
+        surface = None
+        event = self.decoding.pop(key, None)
+        if event is not None:
+            # Being preloaded: wait for the decode instead of doing it twice
+            event.wait()
+            surface = self.decoded.pop(key, None)
+        if surface is None:
+            surface = pygame.image.load(path)
+        if pygame.display.get_surface() is not None:
+            surface = surface.convert_alpha() if alpha else surface.convert()
+        self.images[key] = surface
+        self.count("image", False, self.surface_bytes(surface))
+        return surface
+
+    def preload(self, images):
+        # Decode (path, alpha) images on a background thread.  Only the decode
+        #   runs there; converting to the display format needs the display, so
+        #   image() still does that on the main thread.
+        pending = []
+        for key in images:
+            if key not in self.images and key not in self.decoding:
+                self.decoding[key] = threading.Event()
+                pending.append((key, self.decoding[key]))
+
+        def decode():
+            for key, event in pending:
+                try:
+                    self.decoded[key] = pygame.image.load(key[0])
+                except (pygame.error, IOError):
+                    # image() loads it again on the main thread and raises there
+                    pass
+                event.set()
+
+        thread = threading.Thread(target=decode, name="asset-preload")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def convert_decoded(self):
+        # Convert every image the preload thread has finished decoding, and
+        #   return True once nothing is left to convert
+        for key, event in list(self.decoding.items()):
+            if event.is_set():
+                self.image(*key)
+        return not self.decoding
+
+    def mask(self, surface):
+        # Collision mask for a surface, built the first time it is asked for
+        entry = self.masks.get(id(surface))
+        if entry is not None:
+            self.count("mask", True)
+            return entry[1]
+
+        mask = pygame.mask.from_surface(surface)
+        # Keep the surface alive so its id can't be reused by another one
+        self.masks[id(surface)] = (surface, mask)
+        self.count("mask", False, self.mask_bytes(mask))
+        return mask
+
+    def extent(self, surface):
+        # Half the width and height of a surface, one tuple shared by every
+        #   entity drawing it
+        entry = self.extents.get(id(surface))
+        if entry is None:
+            w, h = surface.get_size()
+            entry = self.extents[id(surface)] = (surface, (w / 2., h / 2.))
+        return entry[1]
+
+    def atlas(self, surface, step=ROTATION_STEP):
+        # Rotation atlas for a surface, rendered the first time it is asked for
+        key = (id(surface), step)
+        entry = self.atlases.get(key)
+        if entry is not None:
+            self.count("atlas", True)
+            return entry[1]
+
+        atlas = RotationAtlas(surface, step)
+        self.atlases[key] = (surface, atlas)
+        size = 0
+        for rotated, mask, offset in atlas.frames:
+            size += self.surface_bytes(rotated) + self.mask_bytes(mask)
+        self.count("atlas", False, size)
+        return atlas
+
+    def report(self):
+        # Hit/miss/byte counts per kind of asset, plus totals
+        report = {}
+        for kind, (hits, misses, size) in self.counters.items():
+            report[kind] = {"hits": hits, "misses": misses, "bytes": size}
+        report["total_bytes"] = sum(counter[2] for counter in self.counters.values())
+        return report
+
+assets = AssetRegistry() # Shared by every world and entity
+
+def asset_jobs():
+    # The asset warm-up every process needs before its first game, one
+    #   callable per step: the player's rotation atlases and the masks of
+    #   the alien and the laser (which load their images too)
+    return [lambda: assets.atlas(assets.image("assets/spaceship.png")),
+        lambda: assets.atlas(assets.image("assets/explosion.png")),
+        lambda: assets.mask(assets.image("assets/enemyship.png")),
+        lambda: assets.mask(assets.image("assets/laser.png"))]
+
+def warm_assets():
+    # Do the whole warm-up at once, for processes with no intro to hide it
+    #   behind (batch workers, servers, bots)
+    for job in asset_jobs():
+        job()
+
+class Startup(object):
+    # Gets the game from launch to its first frame of gameplay.  Images are
+    #   decoded on a background thread while the intro runs, and the intro
+    #   spends a slice of each frame converting them and building the
+    #   rotation atlases, so starting a game has little left to do.  Every
+    #   step is timed from launch for the startup report.
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.marks = OrderedDict() # step -> milliseconds since launch
+        self.jobs = [] # Main thread work left once the images are converted
+
+    def mark(self, name):
+        # Only the first time each step happens is kept
+        if name not in self.marks:
+            self.marks[name] = (time.perf_counter() - self.started) * 1000
+
+    def begin(self):
+        assets.preload(GAME_IMAGES)
+        font = 'assets/BebasNeue-Regular.ttf'
+        self.jobs = asset_jobs() + [lambda: text_cache.font(font, 20)]
+
+    @property
+    def ready(self):
+        return not assets.decoding and not self.jobs
+
+    def warm(self, budget=WARM_UP_SLICE):
+        # Do up to `budget` milliseconds of the remaining warm-up
+        deadline = time.perf_counter() + budget / 1000.
+        if not assets.convert_decoded():
+            return
+        self.mark("assets_decoded")
+        while self.jobs and time.perf_counter() < deadline:
+            self.jobs.pop(0)()
+        if not self.jobs:
+            self.mark("assets_ready")
+
+    def finish(self):
+        # Finish the warm-up now, waiting for the preload thread if needed
+        for key in list(assets.decoding):
+            assets.image(*key)
+        self.mark("assets_decoded")
+        while self.jobs:
+            self.jobs.pop(0)()
+        self.mark("assets_ready")
+
+    def report(self):
+        lines = ["startup (ms since launch)"]
+        for name, ms in self.marks.items():
+            lines.append("  %-18s %8.1f" % (name, ms))
+        # The asset registry's counters, for every asset loaded so far
+        report = assets.report()
+        lines.append("assets (hits / misses / KB held)")
+        for kind in ("image", "mask", "atlas"):
+            counts = report[kind]
+            lines.append("  %-18s %5d / %5d / %8.1f" % (kind, counts["hits"], counts["misses"],
+                counts["bytes"] / 1024.))
+        lines.append("  %-18s %24.1f" % ("total", report["total_bytes"] / 1024.))
+        return "\n".join(lines)
+
+startup = Startup()
 
 class GameEntity(pygame.sprite.Sprite):
     # Creating a base class to store common properties of entities and their actions
+    motion = "seek" # How an EntityStore integrates this entity (None = never stored)
+    layer = 1 # World.render draws lower layers first
+    overlay = False # Has overlay_fills(), drawn on top of every layer
+    turns = False # Its sprite can change while its bounds stay the same
+
     def __init__(self, world, name, image):
         # Call the parent class (Sprite) constructor
         super().__init__()
+        self.store = None # EntityStore holding this entity's movement, if any
+        self.row = None
+        self.ai_period = 1 # Frames between brain updates (see AIScheduler)
         self.world = world
         self.name = name
         self.image = image
         self.rect = self.image.get_rect()
+        self.extent = assets.extent(self.image) # Half size of what sprite() draws
         self.location = vec(0, 0)
         self.destination = vec(0, 0)
         self.speed = 0
         self.brain = StateMachine()
         self.id = 0
-        self.mask = pygame.mask.from_surface(self.image)
+        self.mask = assets.mask(self.image)
+
+    # Movement attributes live on the object, or in the EntityStore row once
+    #   the entity is attached to an array-backed world
+    @property
+    def location(self):
+        if self.row is None:
+            return self._location
+        return vec(*self.store.location[self.row])
+
+    @location.setter
+    def location(self, value):
+        if self.row is None:
+            self._location = value
+        else:
+            self.store.location[self.row] = value
+
+    @property
+    def destination(self):
+        if self.row is None:
+            return self._destination
+        return vec(*self.store.destination[self.row])
+
+    @destination.setter
+    def destination(self, value):
+        if self.row is None:
+            self._destination = value
+        else:
+            self.store.destination[self.row] = value
+
+    @property
+    def direction(self):
+        if self.row is None:
+            return self._direction
+        return vec(*self.store.direction[self.row])
+
+    @direction.setter
+    def direction(self, value):
+        if self.row is None:
+            self._direction = value
+        else:
+            self.store.direction[self.row] = value
+
+    @property
+    def speed(self):
+        if self.row is None:
+            return self._speed
+        return self.store.speed[self.row]
+
+    @speed.setter
+    def speed(self, value):
+        if self.row is None:
+            self._speed = value
+        else:
+            self.store.speed[self.row] = value
+
+    def sprite(self, pose=None):
+        # The surface to draw and its top left corner, centered on location
+        #   (or on an interpolated (x, y, rotation) pose)
+        x, y = self.location if pose is None else pose[:2]
+        half_w, half_h = self.extent
+        return self.image, (x - half_w, y - half_h)
 
     def render(self, surface):
-        # Blits the entities' images onto the screen
-        x, y = self.location
+        # Blits the entities' images onto the screen (World.render batches
+        #   sprite() instead)
+        surface.blit(*self.sprite())
+
+    def bounds(self, pose=None):
+        # Screen area covered by render() (or by drawing at a pose)
+        x, y = self.location if pose is None else pose[:2]
         w, h = self.image.get_size()
-        surface.blit(self.image, (x-w/2, y-h/2))
+        return pygame.Rect(int(x-w/2), int(y-h/2), w + 1, h + 1)
 
-    def process(self, time_passed):
+    def think(self):
         # Run StateMachine to control the entity
         self.brain.think()
 
+    def process(self, time_passed):
+        self.think()
+        self.integrate(time_passed)
+
+    def integrate(self, time_passed):
+        # Move towards the destination without overshooting it
         if self.speed > 0 and self.location != self.destination:
 
             vec_to_destination = self.destination - self.location
@@ -166,11 +1196,16 @@ class GameEntity(pygame.sprite.Sprite):
 
 class Player(GameEntity):
     # Player object holds the same capabilities of Game Entity.
+    motion = None # Player.move drives the player directly
+    layer = 3
+    overlay = True # The health bar
+    turns = True
+
     def __init__(self, world, image):
         # Call the base constructor class
         GameEntity.__init__(self, world, "player", image)
         self.image = image
-        self.dead_image = pygame.image.load('assets/explosion.png').convert_alpha()
+        self.dead_image = assets.image('assets/explosion.png')
         self.health = 100
         self.location = vec(0, 0)
         self.max_speed = 300
@@ -182,28 +1217,74 @@ class Player(GameEntity):
         self.rotation_direction = 0
         self.heading_x = 0
         self.heading_y = 0
+        # Rotations are looked up instead of rendered every frame
+        self.atlas = assets.atlas(self.image)
+        self.dead_atlas = assets.atlas(self.dead_image)
+        self.update_frame()
+
+    def update_frame(self):
+        # Pick the pre-rendered rotation matching the current angle and use
+        #  its mask for collisions
+        self.rotated_player, self.mask, self.draw_offset = self.rotated(self.rotation)
+        self.extent = (-self.draw_offset[0], -self.draw_offset[1])
+
+    def rotated(self, rotation):
+        # The pre-rendered (surface, mask, draw offset) for any angle
+        atlas = self.dead_atlas if self.image is self.dead_image else self.atlas
+        return atlas.get(rotation)
+
+    def sprite(self, pose=None):
+        # The pre-rotated image matching the player's rotation angle, or the
+        #   angle of an interpolated pose
+        if pose is None:
+            self.update_frame()
+            x, y = self.location
+            image, offset = self.rotated_player, self.draw_offset
+        else:
+            x, y, rotation = pose
+            image, mask, offset = self.rotated(rotation)
+        return image, (x + offset[0], y + offset[1])
 
     def render(self, surface):
-        # Rotating image to match the rotation angle of the player and
-        #  blitting to the screen
-        self.rotated_player = pygame.transform.rotate(self.image, self.rotation)
-        w, h = self.rotated_player.get_size()
-        self.sprite_draw_pos = vec(self.location.x - w/2, self.location.y - h/2)
-        surface.blit(self.rotated_player, self.sprite_draw_pos)
-
-        # Draw health bar for player
-        x, y = self.location
+        surface.blit(*self.sprite())
+        self.render_overlay(surface)
+
+    def render_overlay(self, surface):
+        for color, rect in self.overlay_fills():
+            surface.fill(color, rect)
+
+    def overlay_fills(self, pose=None):
+        # Health bar for player, as (color, rect) fills
+        x, y = self.location if pose is None else pose[:2]
         w, h = self.image.get_size()
         bar_x = x - 12
         bar_y = y + h/2
-        surface.fill((255, 0, 0), (bar_x, bar_y, 20, 4))
-        surface.fill((0, 255, 0), (bar_x, bar_y, self.health, 4))
+        return (((255, 0, 0), (bar_x, bar_y, 20, 4)),
+            ((0, 255, 0), (bar_x, bar_y, self.health, 4)))
+
+    def bounds(self, pose=None):
+        # Rotated sprite plus the health bar underneath it
+        if pose is None:
+            self.update_frame()
+            x, y = self.location
+            image, (offset_x, offset_y) = self.rotated_player, self.draw_offset
+        else:
+            x, y, rotation = pose
+            image, mask, (offset_x, offset_y) = self.rotated(rotation)
+        w, h = image.get_size()
+        sprite = pygame.Rect(int(x + offset_x), int(y + offset_y), w + 1, h + 1)
+        bar_h = self.image.get_size()[1]
+        bar = pygame.Rect(int(x - 12), int(y + bar_h/2), max(20, self.health) + 1, 5)
+        return sprite.union(bar)
 
     def attacked(self):
         self.health -= 1
         if self.health <= 0:
+            if self.image is not self.dead_image and self.world.particles is not None:
+                self.world.particles.explode(self.location, count=1500, speed=260., life=1.6)
             self.speed = 0
             self.image = self.dead_image
+            self.update_frame()
 
     def move(self, events, time_passed):
         time_passed_seconds = time_passed / 1000.0
@@ -254,6 +1335,10 @@ class Player(GameEntity):
         # Increasing position of PLayer by heading and speed and time
         self.location += self.heading * self.speed * time_passed_seconds
 
+        # Engine exhaust while the player accelerates
+        if self.acceleration and self.health > 0 and self.world.particles is not None:
+            self.world.particles.thrust(self.location, self.heading)
+
         # Prevent player from leaving the map
         if (self.location.x > SCREEN_SIZE[0]):
             self.location.x = SCREEN_SIZE[0]
@@ -264,17 +1349,26 @@ class Player(GameEntity):
         elif (self.location.y < 0):
             self.location.y = 0
 
+        # Keep the collision mask in step with the new rotation
+        self.update_frame()
+
     def process(self, time_passed):
         #  Updating rect coordinates of projectile to new location.
         #  self.rect = self.image.get_rect(center=self.location)
         pass
 
+    def integrate(self, time_passed):
+        # Player.move drives the player, nothing to integrate
+        pass
+
 class Alien(GameEntity):
 
     def __init__(self, world, image):
         # Call the base constructor class
         GameEntity.__init__(self, world, "alien", image)
-        self.dead_image = pygame.image.load('assets/explosion.png').convert_alpha()
+        self.dead_image = assets.image('assets/explosion.png')
+
+        self.got_kill = False # Set by the hunting state once the player dies
 
         # Create instance of each of the states
         exploring_state = AlienStateExploring(self)
@@ -284,41 +1378,60 @@ class Alien(GameEntity):
         self.brain.add_state(exploring_state)
         self.brain.add_state(hunting_state)
 
-    def render(self, surface):
-        # Call the render function of the base class
-        GameEntity.render(self, surface)
+    def reached(self, player):
+        # Called by Simulation.collide for every step the alien reaches a player
+        state = self.brain.active_state
+        if state is not None:
+            state.behaviour.reached(self, player)
 
-class AlienStateExploring(State):
+class AlienBehaviour(object):
+    # A stateless version of State: one instance is shared by every alien and
+    #   the alien being updated is passed in, so all per-alien data (speed,
+    #   destination, player_id, got_kill) lives on the alien itself.
+    name = None
 
-    def __init__(self, alien):
-        # Call the base class constructor to initialize the state
-        State.__init__(self, "exploring")
-        # Set the alien that this State will manipulate
-        self.alien = alien
+    def do_actions(self, alien):
+        pass
 
-    def random_destination(self):
+    def check_conditions(self, alien):
+        return None
+
+    def entry_actions(self, alien):
+        pass
+
+    def exit_actions(self, alien):
+        pass
+
+    def reached(self, alien, player):
+        # The alien is within ATTACK_RANGE of a player this step (or touches
+        #   it, with Tuning.mask_contacts)
+        pass
+
+class ExploringBehaviour(AlienBehaviour):
+    name = "exploring"
+
+    def random_destination(self, alien):
         # Select a random point on the screen to move towards
         w, h = SCREEN_SIZE
-        self.alien.destination = vec(random.randint(0, w), random.randint(0, h))
+        alien.destination = vec(random.randint(0, w), random.randint(0, h))
 
-    def do_actions(self):
+    def do_actions(self, alien):
         # Change direction 1 in 20 calls
         if random.randint(1, 20) == 1:
-            self.random_destination()
+            self.random_destination(alien)
 
-    def check_conditions(self):
+    def check_conditions(self, alien):
         # If the player is nearby, switch to seeking state
-        player = self.alien.world.get_close_entity("player",
-            self.alien.location)
+        player = alien.world.get_close_entity("player", alien.location, living=True)
         if player is not None:
-            self.alien.player_id = player.id
+            alien.player_id = player.id
             return "hunting"
 
         return None
 
-    def entry_actions(self):
+    def entry_actions(self, alien):
         # Set speed for alien
-        self.alien.speed = 75.
+        alien.speed = alien.world.tuning.explore_speed
         # Select spawn point for alien off of the screen
         spawn_zones = []
         # Randomly generated two spawn points for enemy ships
@@ -329,54 +1442,195 @@ class AlienStateExploring(State):
 
         # Randomly choose spawn point off the map for the enemey ships
         alien_spawn = random.choice(spawn_zones)
-        self.alien.destination = vec(alien_spawn[0], alien_spawn[1])
+        alien.destination = vec(alien_spawn[0], alien_spawn[1])
 
-class AlienStateHunting(State):
+class HuntingBehaviour(AlienBehaviour):
+    name = "hunting"
 
-    def __init__(self, alien):
+    def do_actions(self, alien):
 
-        State.__init__(self, "hunting")
-        self.alien = alien
-        self.got_kill = False
+        player = alien.world.get(alien.player_id)
 
-    def do_actions(self):
+        if player is None:
+            return
 
-        player = self.alien.world.get(self.alien.player_id)
+        alien.destination = player.location
 
-        if player is None:
+    def check_conditions(self, alien):
+
+        player = alien.world.get(alien.player_id)
+
+        # If player is dead or there is no player, return to exploring state
+        if alien.got_kill or player is None or player.health <= 0:
+            return "exploring"
+
+        return None
+
+    def entry_actions(self, alien):
+
+        # Hunters keep their exploring speed unless the tuning gives them one
+        hunt_speed = alien.world.tuning.hunt_speed
+        if hunt_speed is not None:
+            alien.speed = hunt_speed + random.randint(0, 50)
+
+    def exit_actions(self, alien):
+
+        alien.got_kill = False
+
+    def reached(self, alien, player):
+
+        # Only the player being hunted gets attacked, while it is alive
+        if player.id != alien.player_id or player.health <= 0:
             return
 
-        self.alien.destination = player.location
+        # Reduce player's health
+        if random.randint(1, 5) == 1:
+            player.attacked()
 
-        if self.alien.location.distance_to(player.location) < 15:
+            if player.health <= 0:
+                alien.got_kill = True
 
-            # Reduce player's health
-            if random.randint(1, 5) == 1:
-                player.attacked()
+# The only instances of the alien behaviours, shared by every alien
+ALIEN_BEHAVIOURS = {"exploring": ExploringBehaviour(), "hunting": HuntingBehaviour()}
 
-                if player.health <= 0:
-                    self.got_kill = True
+class AlienStateExploring(State):
+    # StateMachine state for an Alien, running the shared exploring behaviour
 
-    def check_conditions(self):
+    def __init__(self, alien):
+        # Call the base class constructor to initialize the state
+        State.__init__(self, "exploring")
+        # Set the alien that this State will manipulate
+        self.alien = alien
+        self.behaviour = ALIEN_BEHAVIOURS["exploring"]
 
-        player = self.alien.world.get(self.alien.player_id)
+    def random_destination(self):
+        self.behaviour.random_destination(self.alien)
 
-        # If player is dead or there is no player, return to exploring state
-        if self.got_kill or player is None:
-            return "exploring"
+    def do_actions(self):
+        self.behaviour.do_actions(self.alien)
 
-        return None
+    def check_conditions(self):
+        return self.behaviour.check_conditions(self.alien)
 
     def entry_actions(self):
+        self.behaviour.entry_actions(self.alien)
+
+class AlienStateHunting(State):
+    # StateMachine state for an Alien, running the shared hunting behaviour
+
+    def __init__(self, alien):
+
+        State.__init__(self, "hunting")
+        self.alien = alien
+        self.behaviour = ALIEN_BEHAVIOURS["hunting"]
+
+    def do_actions(self):
+        self.behaviour.do_actions(self.alien)
 
-        self.speed = 75. + random.randint(0, 50)
+    def check_conditions(self):
+        return self.behaviour.check_conditions(self.alien)
+
+    def entry_actions(self):
+        self.behaviour.entry_actions(self.alien)
 
     def exit_actions(self):
+        self.behaviour.exit_actions(self.alien)
+
+class CompactAlien(object):
+    # A low-memory alien for very large simulations: no Sprite base, no
+    #   per-instance dict, StateMachine or state objects.  It is its own
+    #   brain and runs the shared ALIEN_BEHAVIOURS.  Movement, rendering and
+    #   the location/destination/speed attributes are GameEntity's own.
+    __slots__ = ("world", "image", "mask", "extent", "id", "store", "row", "ai_period",
+        "_location", "_destination", "_speed", "active_state", "player_id", "got_kill")
+    name = "alien"
+    motion = "seek"
+    layer = GameEntity.layer
+    overlay = False
+    turns = False
+    states = ALIEN_BEHAVIOURS
 
+    def __init__(self, world, image):
+        self.world = world
+        self.image = image
+        self.mask = assets.mask(image)
+        self.extent = assets.extent(image)
+        self.id = 0
+        self.store = None
+        self.row = None
+        self.ai_period = 1
+        self._location = vec(0, 0)
+        self._destination = vec(0, 0)
+        self._speed = 0
+        self.active_state = None
         self.got_kill = False
 
+    @property
+    def brain(self):
+        # The alien doubles as its own state machine
+        return self
+
+    def think(self):
+        state = self.active_state
+        if state is None:
+            return
+
+        state.do_actions(self)
+        new_state_name = state.check_conditions(self)
+        if new_state_name is not None:
+            self.set_state(new_state_name)
+
+    def set_state(self, new_state_name):
+        if self.active_state is not None:
+            self.active_state.exit_actions(self)
+
+        self.active_state = self.states[new_state_name]
+        self.active_state.entry_actions(self)
+
+    def reached(self, player):
+        if self.active_state is not None:
+            self.active_state.reached(self, player)
+
+    location = GameEntity.location
+    destination = GameEntity.destination
+    speed = GameEntity.speed
+    sprite = GameEntity.sprite
+    render = GameEntity.render
+    bounds = GameEntity.bounds
+    process = GameEntity.process
+    integrate = GameEntity.integrate
+
+def alien_memory_report(count=10000):
+    # Bytes per alien, measured with tracemalloc, for Alien and CompactAlien
+    #   (surfaces and masks are shared and not counted)
+    import tracemalloc
+    world = World()
+    image = assets.image("assets/enemyship.png")
+    assets.mask(image)
+    report = {}
+    for alien_class in (Alien, CompactAlien):
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        aliens = []
+        for i in range(count):
+            alien = alien_class(world, image)
+            world.add_entity(alien)
+            alien.location = vec(random.randint(0, SCREEN_SIZE[0]), random.randint(0, SCREEN_SIZE[1]))
+            alien.brain.set_state("exploring")
+            aliens.append(alien)
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+        report[alien_class.__name__] = allocated / float(count)
+        world.clear()
+        del aliens
+    return report
+
 class Projectile(GameEntity):
     # Projectile object holds the same capabilities of Game Entity.
+    motion = "ballistic"
+    layer = 2 # Over the aliens, under the player
+
     def __init__(self, world, image):
         # Firing projectile based on location and direction of Player
         GameEntity.__init__(self, world, "projectile", image)
@@ -387,31 +1641,787 @@ class Projectile(GameEntity):
         self.direction = vec(degree_x, degree_y)
         return self.location, self.direction
 
-    def do_actions(self):
-        pass
-        # alien = self.alien.world.get(self.alien.player_id)
-
-    def render(self, surface):
-        # Call the render function of the base class
-        GameEntity.render(self, surface)
-        # Call the base function of the Game Entity
-        x, y = self.location # pass in player's current location
-        w, h = self.image.get_size()
-        self.rect = self.image.get_rect(center=self.rect.center)
-        surface.blit(self.image, (x, y, w, h))
-
-    def process(self, time_passed):
+    def integrate(self, time_passed):
         # Firing projectile based on location and direction of Player
         #  updating rect coordinates of projectile to new location.
         self.location += self.direction * self.speed * time_passed
 
+class ProjectilePool(object):
+    # A fixed number of projectiles created up front.  Firing takes one off
+    #   the free list and despawning puts it back, so steady rapid fire never
+    #   creates or destroys Projectile objects.
+    def __init__(self, world, image, capacity=MAX_PROJECTILES):
+        self.world = world
+        self.capacity = capacity
+        self.free = [Projectile(world, image) for i in range(capacity)]
+        self.live = {} # entity id -> projectile currently in the world
+        self.fired = 0 # Projectiles handed out in total
+        self.peak = 0 # Most projectiles ever in flight at once
+        self.exhausted = 0 # Shots dropped because the pool was empty
+
+    def fire(self, location, heading):
+        # Launch a projectile from location along heading (or None if every
+        #  projectile is already in flight)
+        if not self.free:
+            self.exhausted += 1
+            return None
+
+        projectile = self.free.pop()
+        self.world.add_entity(projectile)
+        projectile.fire_laser(location[0], location[1], heading[0], heading[1], 0)
+        self.live[projectile.id] = projectile
+        self.fired += 1
+        if len(self.live) > self.peak:
+            self.peak = len(self.live)
+        return projectile
+
+    def release(self, projectile):
+        # Take a projectile out of the world and back onto the free list
+        del self.live[projectile.id]
+        self.world.remove_entity(projectile)
+        self.free.append(projectile)
+
+    def reset(self):
+        # Put every projectile back on the free list, for a world that has
+        #  already been cleared
+        self.free.extend(self.live.values())
+        self.live.clear()
+
+    def claim(self, projectile):
+        # Track a projectile taken off the free list by World.restore
+        self.live[projectile.id] = projectile
+        if len(self.live) > self.peak:
+            self.peak = len(self.live)
+
+    def despawn_offscreen(self):
+        # Release every projectile that left the screen
+        w, h = SCREEN_SIZE
+        gone = []
+        for projectile in self.live.values():
+            x, y = projectile.location
+            if x < 0 or x > w or y < 0 or y > h:
+                gone.append(projectile)
+        for projectile in gone:
+            self.release(projectile)
+
+    def stats(self):
+        # Occupancy and exhaustion counters
+        return {"capacity": self.capacity, "in_use": len(self.live),
+            "peak": self.peak, "fired": self.fired, "exhausted": self.exhausted}
+
+# score, frame, time, player acceleration, movement and rotation direction,
+#   then the Mersenne Twister state of the random module
+SIMULATION_HEADER = struct.Struct("<IIdhbb625I")
+
+class Simulation(object):
+    # The rules of one game without any display, font or blitting.  Each call
+    #   to step() advances the world by time_passed milliseconds using the
+    #   given input events.  GameScene feeds it real events and clock time,
+    #   headless runs feed it scripted events at a fixed time step.
+    def __init__(self, background=None, seed=None, alien_count=None, array_storage=False,
+            tuning=None, compact_aliens=False):
+        self.profiler = profiler
+        self.tuning = tuning if tuning is not None else Tuning()
+        self.alien_count = alien_count if alien_count is not None else self.tuning.alien_count
+        self.world = World(background, array_storage=array_storage, tuning=self.tuning)
+        self.projectiles = ProjectilePool(self.world, assets.image("assets/laser.png"))
+        self.collisions = CollisionSystem(self.world)
+        self.enemy_image = assets.image("assets/enemyship.png")
+        # Slotted aliens with shared states, for very large simulations
+        self.alien_class = CompactAlien if compact_aliens else Alien
+        self.reset(seed)
+
+    def reset(self, seed=None):
+        # Start a new game in the same world, keeping the projectile pool and
+        #   everything already loaded
+        if seed is not None:
+            random.seed(seed)
+        self.seed = seed
+        self.world.clear()
+        self.projectiles.reset()
+        self.player = Player(self.world, assets.image("assets/spaceship.png"))
+        self.player.health = self.tuning.player_health
+        self.player.max_speed = self.tuning.player_max_speed
+        self.player.location = vec(SCREEN_SIZE[0]/2, SCREEN_SIZE[1]/2)
+        self.world.add_entity(self.player)
+        self.score = 0
+        self.frame = 0 # Steps simulated so far
+        self.time = 0. # Milliseconds simulated so far
+        self.add_aliens(self.alien_count)
+        self.world.sync()
+
+    @property
+    def game_over(self):
+        return self.player.health <= 0
+
+    @property
+    def finished(self):
+        # Over, and the player's explosion has played out
+        particles = self.world.particles
+        return self.game_over and (particles is None or not particles.count)
+
+    def settle(self, time_passed):
+        # Once the game is over only the particles move on, until finished
+        if self.world.particles is not None:
+            self.world.particles.update(time_passed / 1000.0)
+
+    def add_aliens(self, alien_count):
+        # Create list of spawn zones for aliens
+        spawn_zones = []
+        # Randomly generated two spawn points for enemy ships
+        spawn1_coords = ([-50, random.randint(0, SCREEN_SIZE[1])])
+        spawn_zones.append(spawn1_coords)
+        spawn2_coords = (SCREEN_SIZE[0] + 50, random.randint(0, SCREEN_SIZE[1]))
+        spawn_zones.append(spawn2_coords)
+
+        # Randomly choose spawn point off the map for the enemey ships
+        alien_spawn = random.choice(spawn_zones)
+
+        for alien_no in range(alien_count):
+            alien = self.alien_class(self.world, self.enemy_image)
+            self.world.spawn(alien)
+            alien.location = vec(alien_spawn[0], alien_spawn[1])
+            alien.brain.set_state("exploring")
+
+    def step(self, events, time_passed):
+        # Passing keys and key events to player.
+        self.player.move(events, time_passed)
+        self.profiler.lap("move")
+        self.world.process(time_passed)
+        self.profiler.lap("process")
+
+        self.fire(self.player, events)
+        # Returning projectiles that left the screen to the pool
+        self.projectiles.despawn_offscreen()
+        self.profiler.lap("fire")
+
+        self.collide()
+        # Spawns and despawns made during the step take effect together
+        self.world.sync()
+        self.profiler.lap("collision")
+
+        self.frame += 1
+        self.time += time_passed
+
+    def fire(self, player, events):
+        for e in events:
+            if e.type == pygame.KEYDOWN and e.key == pygame.K_SPACE:
+                # Taking a projectile from the pool and firing it along
+                #   the player's heading
+                self.projectiles.fire(player.location, player.heading)
+
+    def collide(self):
+        # Aliens right on top of a player may attack it
+        if self.tuning.mask_contacts:
+            contacts = self.collisions.collide("player", "alien")
+        else:
+            contacts = self.collisions.within("player", "alien", ATTACK_RANGE)
+        for playerObj, alienObj in contacts:
+            alienObj.reached(playerObj)
+
+        # Only aliens near a live projectile are ever mask tested
+        destroyed = {}
+        for projectileObj, alienObj in self.collisions.collide("projectile", "alien"):
+            destroyed[alienObj.id] = alienObj
+
+        for alienObj in destroyed.values():
+            self.world.despawn(alienObj)
+            if self.world.particles is not None:
+                self.world.particles.explode(alienObj.location)
+            self.score += 1
+            self.add_aliens(random.randint(self.tuning.respawn_min, self.tuning.respawn_max))
+
+    def run(self, frames, script=None, time_passed=FIXED_DT):
+        # Step until the player dies or frames run out, as fast as possible.
+        #   script(frame) returns the input events for that frame.
+        while self.frame < frames and not self.game_over:
+            events = script(self.frame) if script is not None else []
+            self.step(events, time_passed)
+        return self.result()
+
+    def snapshot(self):
+        # Score, frame counters and RNG state followed by the world snapshot
+        version, internal, gauss_next = random.getstate()
+        player = self.player
+        header = SIMULATION_HEADER.pack(self.score, self.frame, self.time, player.acceleration,
+            player.movement_direction, player.rotation_direction, *internal)
+        return header + self.world.snapshot()
+
+    def restore(self, data):
+        # Roll the game back (or forward) to a snapshot from snapshot()
+        values = SIMULATION_HEADER.unpack_from(data, 0)
+        self.score, self.frame, self.time = values[:3]
+        acceleration, movement_direction, rotation_direction = values[3:6]
+        random.setstate((3, tuple(values[6:]), None))
+
+        self.projectiles.reset()
+        def factory(name):
+            if name == "player":
+                player = Player(self.world, assets.image("assets/spaceship.png"))
+                player.max_speed = self.tuning.player_max_speed
+                self.player = player
+                return player
+            if name == "alien":
+                return self.alien_class(self.world, self.enemy_image)
+            return self.projectiles.free.pop()
+        self.world.restore(data[SIMULATION_HEADER.size:], factory)
+
+        for entity in self.world.entities.values():
+            if entity.name == "projectile":
+                self.projectiles.claim(entity)
+        self.player.acceleration = acceleration
+        self.player.movement_direction = movement_direction
+        self.player.rotation_direction = rotation_direction
+        if self.player.health <= 0:
+            self.player.image = self.player.dead_image
+        self.player.update_frame()
+
+    def result(self):
+        return {"seed": self.seed, "score": self.score, "frames": self.frame,
+            "survival_time": self.time / 1000.0, "health": self.player.health}
+
+class RenderFrame(object):
+    # Everything needed to draw one simulation step, captured on the
+    #   simulation thread: the culled (surface, position) blits in layer order,
+    #   overlay fills, particle copies, entity counts, the score and whether
+    #   the game is finished.  Nothing
+    #   in it is changed after it is published, so the drawing thread needs no
+    #   lock (and never has to look at the world itself).
+    __slots__ = ("step", "sprites", "fills", "particles", "counts", "score", "finished")
+
+    def __init__(self, simulation):
+        world = simulation.world
+        sprites, fills = world.sprites(world.entities.values(), SCREEN_SIZE)
+        self.step = simulation.frame
+        self.sprites = tuple(sprites)
+        self.fills = tuple(fills)
+        self.particles = world.particles.snapshot() if world.particles is not None else None
+        self.counts = Counter(entity.name for entity in world.entities.values())
+        self.score = simulation.score
+        self.finished = simulation.finished
+
+class SimulationPipeline(object):
+    # Steps a Simulation at FIXED_DT on its own thread and publishes a
+    #   RenderFrame after every step.  The main thread hands over input with
+    #   push() and draws whichever frame is newest, so drawing one step
+    #   overlaps simulating the next instead of adding to it (pygame lets go
+    #   of the GIL while it blits and updates the display).
+    def __init__(self, simulation, recorder=None):
+        self.simulation = simulation
+        self.recorder = recorder
+        self.events = queue.Queue() # Input waiting for the next step
+        self.latest = None # Newest RenderFrame
+        self.step_times = [] # Seconds each step took, with its frame capture
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="simulation")
+        self.thread.daemon = True
+
+    def start(self):
+        # The first frame is published before the thread starts, so there is
+        #   always one to draw
+        self.latest = RenderFrame(self.simulation)
+        self.thread.start()
+
+    def push(self, events):
+        for e in events:
+            self.events.put(e)
+
+    def run(self):
+        simulation = self.simulation
+        next_step = time.perf_counter()
+        while not self.stopping.is_set() and not simulation.finished:
+            events = []
+            while not self.events.empty():
+                events.append(self.events.get_nowait())
+            started = time.perf_counter()
+            if simulation.game_over:
+                simulation.settle(FIXED_DT)
+            else:
+                if self.recorder is not None:
+                    self.recorder.record(events, FIXED_DT)
+                simulation.step(events, FIXED_DT)
+            # Publishing is a single assignment, so readers see the old frame
+            #   or the new one and never a half-built one
+            self.latest = RenderFrame(simulation)
+            self.step_times.append(time.perf_counter() - started)
+
+            next_step += FIXED_DT / 1000.
+            delay = next_step - time.perf_counter()
+            if delay > 0:
+                self.stopping.wait(delay)
+            else:
+                next_step = time.perf_counter()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+def random_pilot(seed=None):
+    # Scripted input that steers randomly and keeps firing, for headless runs
+    rng = random.Random(seed)
+    steering = (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN)
+
+    def script(frame):
+        events = []
+        if frame % 15 == 0:
+            for key in steering:
+                events.append(pygame.event.Event(pygame.KEYUP, key=key))
+            events.append(pygame.event.Event(pygame.KEYDOWN, key=rng.choice(steering[:3])))
+        if rng.randint(1, 6) == 1:
+            events.append(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_SPACE))
+        return events
+    return script
+
+def run_headless(frames, seed=None, script=None, **options):
+    # Play one game with no display at all and return its result
+    simulation = Simulation(seed=seed, **options)
+    return simulation.run(frames, script)
+
+# Replay files: header, then one record per frame.  A frame record starts with
+#   a byte holding the time step in ms (127 = a little-endian u16 follows,
+#   126 = one FIXED_DT step) and a high bit set when key events follow as a
+#   count byte and one byte per event (high bit = key down, low bits = index
+#   in REPLAY_KEYS).  The version changes whenever the same input plays out
+#   differently: version 3 games reuse entity slots, which changes the ids
+#   that stagger the AI scheduler, and version 4 hunters no longer draw an
+#   unused hunting speed.
+REPLAY_HEADER = struct.Struct("<4sBq") # magic, version, seed
+REPLAY_MAGIC = b"SHRP"
+REPLAY_VERSION = 4
+REPLAY_FIXED_STEP = 126
+REPLAY_KEYS = (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN, pygame.K_SPACE)
+
+class InputRecorder(object):
+    # Writes a game's seed and every frame's time step and key events to a
+    #   binary stream, flushing every few frames so a session is never held
+    #   in memory.
+    def __init__(self, stream, seed, flush_every=30):
+        self.stream = stream
+        self.flush_every = flush_every
+        self.key_index = dict((key, i) for i, key in enumerate(REPLAY_KEYS))
+        self.pending = bytearray()
+        self.frames = 0
+        self.bytes = REPLAY_HEADER.size
+        stream.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, seed))
+
+    def record(self, events, time_passed):
+        codes = []
+        for e in events:
+            if e.type in (pygame.KEYDOWN, pygame.KEYUP) and e.key in self.key_index:
+                codes.append(self.key_index[e.key] | (0x80 if e.type == pygame.KEYDOWN else 0))
+
+        flag = 0x80 if codes else 0
+        if time_passed == FIXED_DT:
+            # Fixed steps aren't whole milliseconds, so they get their own code
+            self.pending.append(flag | REPLAY_FIXED_STEP)
+        elif int(time_passed) < REPLAY_FIXED_STEP:
+            self.pending.append(flag | int(time_passed))
+        else:
+            self.pending.append(flag | 127)
+            self.pending += struct.pack("<H", min(int(time_passed), 0xffff))
+        if codes:
+            self.pending.append(len(codes))
+            self.pending += bytes(codes)
+
+        self.frames += 1
+        if self.frames % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        if self.stream.closed:
+            return
+        self.stream.write(self.pending)
+        self.stream.flush()
+        self.bytes += len(self.pending)
+        self.pending = bytearray()
+
+    def close(self):
+        # Safe to call more than once
+        self.flush()
+        self.stream.close()
+
+def read_replay(stream):
+    # Return (seed, frames) where frames yields (events, time_passed) for each
+    #   recorded frame, reading the stream as it goes
+    magic, version, seed = REPLAY_HEADER.unpack(stream.read(REPLAY_HEADER.size))
+    if magic != REPLAY_MAGIC:
+        raise ValueError("Not a Space Hunter replay (version %d)" % REPLAY_VERSION)
+    if version != REPLAY_VERSION:
+        raise ValueError("Replay version %d was recorded by an older Space Hunter and would not "
+            "play out the same, this one plays version %d" % (version, REPLAY_VERSION))
+
+    def frames():
+        while True:
+            head = stream.read(1)
+            if not head:
+                return
+            time_passed = head[0] & 0x7f
+            if time_passed == 127:
+                time_passed = struct.unpack("<H", stream.read(2))[0]
+            elif time_passed == REPLAY_FIXED_STEP:
+                time_passed = FIXED_DT
+            events = []
+            if head[0] & 0x80:
+                for code in stream.read(stream.read(1)[0]):
+                    event_type = pygame.KEYDOWN if code & 0x80 else pygame.KEYUP
+                    events.append(pygame.event.Event(event_type, key=REPLAY_KEYS[code & 0x7f]))
+            yield events, time_passed
+    return seed, frames()
+
+def replay(path, **options):
+    # Play a recording back with no display, as fast as possible.  The game
+    #   is deterministic given its seed, inputs and time steps.
+    with open(path, "rb") as stream:
+        seed, frames = read_replay(stream)
+        simulation = Simulation(seed=seed, **options)
+        started = time.perf_counter()
+        for events, time_passed in frames:
+            simulation.step(events, time_passed)
+        elapsed = time.perf_counter() - started
+    result = simulation.result()
+    result["elapsed"] = elapsed
+    return result
+
+def star_layers(count):
+    # Split a star count into far, middle and near parallax layers of
+    #   (count, speed in pixels per frame, color)
+    far = count * 6 // 10
+    middle = count * 3 // 10
+    return ((far, 0.5, (110, 110, 110)), (middle, 1, grey), (count - far - middle, 2, white))
+
+class Starfield(object):
+    # Parallax layers of stars scrolling down the screen.  Each layer keeps its
+    #   star positions in NumPy arrays that are advanced and wrapped in one
+    #   step, and all stars are drawn in one batch through surfarray.  Without
+    #   numpy it falls back to plain lists and set_at.
+    def __init__(self, size, layers, seed=None):
+        self.width, self.height = size
+        self.layers = [] # [xs, ys, speed, color] per layer
+        if np is not None:
+            self.rng = np.random.default_rng(seed)
+            for count, speed, color in layers:
+                xs = self.rng.integers(0, self.width, count)
+                ys = self.rng.uniform(0, self.height, count)
+                self.layers.append([xs, ys, speed, color])
+        else:
+            self.rng = random.Random(seed)
+            for count, speed, color in layers:
+                xs = [self.rng.randrange(self.width) for i in range(count)]
+                ys = [self.rng.uniform(0, self.height) for i in range(count)]
+                self.layers.append([xs, ys, speed, color])
+
+    def update(self):
+        # Move every star down by its layer speed; stars leaving the bottom
+        #   come back at the top with a new random x-coord
+        for layer in self.layers:
+            xs, ys, speed, color = layer
+            if np is not None:
+                ys += speed
+                wrapped = ys >= self.height
+                count = int(np.count_nonzero(wrapped))
+                if count:
+                    ys[wrapped] -= self.height
+                    xs[wrapped] = self.rng.integers(0, self.width, count)
+                continue
+            for i in range(len(ys)):
+                ys[i] += speed
+                if ys[i] >= self.height:
+                    ys[i] -= self.height
+                    xs[i] = self.rng.randrange(self.width)
+
+    def draw(self, surface):
+        if np is None:
+            for xs, ys, speed, color in self.layers:
+                for x, y in zip(xs, ys):
+                    surface.set_at((x, int(y)), color)
+            return
+
+        # One locked write per layer instead of one set_at per star
+        pixels = pygame.surfarray.pixels2d(surface)
+        for xs, ys, speed, color in self.layers:
+            pixels[xs, ys.astype(np.intp)] = surface.map_rgb(color)
+        del pixels
+
+class ParticleSystem(object):
+    # Explosion and thruster particles kept in NumPy arrays: position,
+    #   velocity, life left, starting life and color per particle, with the
+    #   live ones packed at the front.  update() moves, ages and culls every
+    #   particle in one vectorized step and draw() writes them all to the
+    #   surface through surfarray in one batch.  Particles are only for show,
+    #   so they use their own random generator and never change the game's.
+    EXPLOSION_COLORS = ((255, 240, 160), (255, 190, 60), (255, 120, 20), (220, 50, 20))
+    THRUST_COLORS = ((160, 220, 255), (90, 160, 255), (255, 255, 255))
+
+    def __init__(self, size, capacity=MAX_PARTICLES, seed=None):
+        if np is None:
+            raise RuntimeError("ParticleSystem needs numpy")
+        self.width, self.height = size
+        self.capacity = capacity
+        self.rng = np.random.default_rng(seed)
+        self.position = np.zeros((capacity, 2))
+        self.velocity = np.zeros((capacity, 2))
+        self.life = np.zeros(capacity) # Seconds left
+        self.max_life = np.ones(capacity) # Seconds it started with
+        self.color = np.zeros((capacity, 3), np.uint8)
+        self.count = 0 # Live particles, in the first `count` rows
+        self.explosion_colors = np.array(self.EXPLOSION_COLORS, np.uint8)
+        self.thrust_colors = np.array(self.THRUST_COLORS, np.uint8)
+
+    def emit(self, location, velocity, life, colors):
+        # Add particles from arrays of velocities, lives and colors (one
+        #   row each) all starting at location
+        count = min(len(velocity), self.capacity - self.count)
+        if count <= 0:
+            return
+        rows = slice(self.count, self.count + count)
+        self.position[rows] = (location[0], location[1])
+        self.velocity[rows] = velocity[:count]
+        self.life[rows] = life[:count]
+        self.max_life[rows] = life[:count]
+        self.color[rows] = colors[:count]
+        self.count += count
+
+    def explode(self, location, count=300, speed=160., life=0.9):
+        # A burst flying out evenly in every direction
+        angles = self.rng.uniform(0, 2 * math.pi, count)
+        speeds = speed * np.sqrt(self.rng.uniform(0, 1, count))
+        velocity = np.column_stack((np.cos(angles) * speeds, np.sin(angles) * speeds))
+        lives = life * self.rng.uniform(0.4, 1, count)
+        colors = self.explosion_colors[self.rng.integers(0, len(self.explosion_colors), count)]
+        self.emit(location, velocity, lives, colors)
+
+    def thrust(self, location, direction, count=12, speed=120., life=0.35):
+        # Exhaust streaming out opposite to `direction`, spread by 20 degrees
+        base = math.atan2(-direction[1], -direction[0])
+        angles = base + self.rng.uniform(-0.35, 0.35, count)
+        speeds = speed * self.rng.uniform(0.5, 1, count)
+        velocity = np.column_stack((np.cos(angles) * speeds, np.sin(angles) * speeds))
+        lives = life * self.rng.uniform(0.5, 1, count)
+        colors = self.thrust_colors[self.rng.integers(0, len(self.thrust_colors), count)]
+        self.emit(location, velocity, lives, colors)
+
+    def update(self, time_passed_seconds):
+        # Move and age every particle, then pack the survivors (still alive
+        #   and still on screen) back into the first rows
+        count = self.count
+        if not count:
+            return
+        position = self.position[:count]
+        life = self.life[:count]
+        position += self.velocity[:count] * time_passed_seconds
+        self.velocity[:count] *= 0.97 # Drag
+        life -= time_passed_seconds
+
+        alive = ((life > 0) & (position[:, 0] >= 0) & (position[:, 0] < self.width)
+            & (position[:, 1] >= 0) & (position[:, 1] < self.height))
+        survivors = int(np.count_nonzero(alive))
+        if survivors < count:
+            for values in (self.position, self.velocity, self.life, self.max_life, self.color):
+                values[:survivors] = values[:count][alive]
+            self.count = survivors
+
+    def draw(self, surface):
+        self.draw_snapshot(surface, self.snapshot())
+
+    def bounds(self):
+        # The rect every live particle is drawn in, or None when there are none
+        count = self.count
+        if not count:
+            return None
+        position = self.position[:count]
+        left, top = (int(value) for value in position.min(axis=0))
+        right, bottom = (int(value) for value in position.max(axis=0))
+        return pygame.Rect(left, top, right - left + 2, bottom - top + 2)
+
+    def snapshot(self):
+        # Copies of what draw() needs (x, y, faded color), safe to draw from
+        #   another thread while the particles move on
+        count = self.count
+        xs = self.position[:count, 0].astype(np.intp)
+        ys = self.position[:count, 1].astype(np.intp)
+        fade = self.life[:count] / self.max_life[:count]
+        rgb = (self.color[:count] * fade[:, None]).astype(np.uint32)
+        return xs, ys, rgb
+
+    def draw_snapshot(self, surface, snapshot):
+        # Every particle is a 2x2 dot fading out with its life, written
+        #   straight into the surface's pixels as mapped colors
+        xs, ys, rgb = snapshot
+        if not len(xs):
+            return
+        width, height = surface.get_size()
+        # Particles are only culled when they move, so new ones can still be
+        #   off the surface (negative indices would wrap to the far edge)
+        on_surface = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        if not on_surface.all():
+            xs, ys, rgb = xs[on_surface], ys[on_surface], rgb[on_surface]
+        xs = np.minimum(xs, width - 2)
+        ys = np.minimum(ys, height - 2)
+        shifts = surface.get_shifts()
+        losses = surface.get_losses()
+        mapped = np.zeros(len(xs), np.uint32)
+        for channel in range(3):
+            mapped |= (rgb[:, channel] >> losses[channel]) << shifts[channel]
+        pixels = pygame.surfarray.pixels2d(surface)
+        pixels[xs, ys] = mapped
+        pixels[xs + 1, ys] = mapped
+        pixels[xs, ys + 1] = mapped
+        pixels[xs + 1, ys + 1] = mapped
+        del pixels
+
+class TextCache(object):
+    # Fonts are opened once per (path, size) and rendered text is kept in an
+    #   LRU keyed by (font, text, color, antialias), so unchanged strings are
+    #   never rasterized twice.  Cached surfaces are shared: don't draw on them.
+    def __init__(self, max_surfaces=TEXT_CACHE_SIZE):
+        self.fonts = {} # (path, size) -> pygame.font.Font
+        self.surfaces = OrderedDict() # (font, text, color, antialias) -> surface
+        self.max_surfaces = max_surfaces
+        self.hits = 0
+        self.misses = 0
+
+    def font(self, path, size):
+        key = (path, size)
+        font = self.fonts.get(key)
+        if font is None:
+            font = pygame.font.Font(path, size)
+            self.fonts[key] = font
+        return font
+
+    def render(self, font, text, color, antialias=True):
+        key = (font, text, tuple(color), antialias)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+
+        self.misses += 1
+        surface = font.render(text, antialias, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_surfaces:
+            self.surfaces.popitem(last=False)
+        return surface
+
+text_cache = TextCache() # Shared by every screen of the game
+
 def text_objects(text, font, color):
     # Create a new surface with the specified text on it. Surface returned
     #  will be the dimensions required to hold the text.
-    textSurface = font.render(text, True, color)
+    textSurface = text_cache.render(font, text, color)
     return textSurface, textSurface.get_rect()
 
+class FrameProfiler(object):
+    # Times each phase of a frame with perf_counter_ns into a fixed-size ring
+    #   buffer, together with the number of entities of each name.  Every call
+    #   returns straight away while disabled, so it can stay in the game loop.
+    PHASES = ("events", "wait", "move", "process", "fire", "collision",
+        "render", "hud", "display")
+
+    def __init__(self, capacity=PROFILE_FRAMES, enabled=False):
+        self.capacity = capacity
+        self.enabled = enabled
+        self.overlay = False # Draw the summary on screen
+        self.phase_index = dict((phase, i) for i, phase in enumerate(self.PHASES))
+        # One ring buffer of nanoseconds per phase, indexed by frame % capacity
+        self.timings = [array('q', [0]) * capacity for phase in self.PHASES]
+        self.counts = [None] * capacity # Entity counts by name per frame
+        self.frames = 0 # Frames recorded in total
+        self.active = False # Recording the current frame
+        self.slot = 0
+        self.last = 0
+        self.overlay_lines = []
+
+    def begin_frame(self):
+        self.active = self.enabled
+        if not self.active:
+            return
+        self.slot = self.frames % self.capacity
+        for timings in self.timings:
+            timings[self.slot] = 0
+        self.last = time.perf_counter_ns()
+
+    def lap(self, phase):
+        # Charge the time since the previous lap to a phase
+        if not self.active:
+            return
+        now = time.perf_counter_ns()
+        self.timings[self.phase_index[phase]][self.slot] += now - self.last
+        self.last = now
+
+    def end_frame(self, counts):
+        # counts: entities by name this frame
+        if not self.active:
+            return
+        self.counts[self.slot] = counts
+        self.frames += 1
+        self.active = False
+
+    def recorded(self):
+        # Ring buffer slots in the order their frames were recorded
+        count = min(self.frames, self.capacity)
+        first = self.frames - count
+        return [(first + i, (first + i) % self.capacity) for i in range(count)]
+
+    def rows(self):
+        # One dict per recorded frame: frame number, ms per phase, entity counts
+        rows = []
+        for frame, slot in self.recorded():
+            row = {"frame": frame}
+            for phase, timings in zip(self.PHASES, self.timings):
+                row[phase] = timings[slot] / 1e6
+            row["total"] = sum(row[phase] for phase in self.PHASES)
+            row["entities"] = dict(self.counts[slot])
+            rows.append(row)
+        return rows
+
+    def summary(self):
+        # Mean ms per phase over the buffer and the latest entity counts
+        rows = self.rows()
+        if not rows:
+            return {}, {}
+        means = {}
+        for phase in self.PHASES + ("total",):
+            means[phase] = sum(row[phase] for row in rows) / len(rows)
+        return means, rows[-1]["entities"]
+
+    def dump(self, path):
+        # Write the buffer as JSON, or as CSV when path ends in .csv
+        rows = self.rows()
+        if path.endswith(".csv"):
+            names = sorted(set(name for row in rows for name in row["entities"]))
+            with open(path, "w", newline="") as out:
+                writer = csv.writer(out)
+                writer.writerow(("frame",) + self.PHASES + ("total",) + tuple(names))
+                for row in rows:
+                    writer.writerow([row["frame"]] + [row[phase] for phase in self.PHASES]
+                        + [row["total"]] + [row["entities"].get(name, 0) for name in names])
+        else:
+            with open(path, "w") as out:
+                json.dump({"phases": list(self.PHASES), "frames": rows}, out)
+
+    def draw_overlay(self, surface, font):
+        # Draw the summary in the top left corner and return the covered rect
+        if self.frames % 15 == 0 or not self.overlay_lines:
+            means, counts = self.summary()
+            self.overlay_lines = ["%s %.2f ms" % (phase, means[phase])
+                for phase in self.PHASES + ("total",) if phase in means]
+            self.overlay_lines += ["%s x%d" % item for item in sorted(counts.items())]
+        rect = pygame.Rect(10, 10, 0, 0)
+        y = 10
+        for line in self.overlay_lines:
+            line_surface, line_rect = text_objects(line, font, white)
+            line_rect.topleft = (10, y)
+            surface.blit(line_surface, line_rect)
+            rect.union_ip(line_rect)
+            y += line_rect.height
+        return rect
+
+profiler = FrameProfiler() # Enabled with --profile or the F3 overlay
+
 def button(screenname, textType, msg, x, y, wdth, hght, act_clr, inact_clr, action=None):
+    # Draw a button and return its action if it is being clicked
 
     mouse = pygame.mouse.get_pos()
     click = pygame.mouse.get_pressed()
@@ -422,196 +2432,66 @@ def button(screenname, textType, msg, x, y, wdth, hght, act_clr, inact_clr, acti
         textRect.center = ((x + (wdth/2)), (y + (hght/2)))
         screenname.blit(textSurf, textRect)
         if click[0] == 1 and action != None:
-            if action == "play":
-                main()
-            elif action == "quit":
-                pygame.quit()
-                quit()
+            return action
     else:
         pygame.draw.rect(screenname, grey, (x, y, wdth, hght))
         textSurf, textRect = text_objects(msg, textType, black)
         textRect.center = ((x + (wdth/2)), (y + (hght/2)))
         screenname.blit(textSurf, textRect)
+    return None
+
+def end_scene(surf, score, text, x, y):
+    final_score = str(score)
+    font = text_cache.font('assets/BebasNeue-Regular.ttf', 20)
+    text_surface = text_cache.render(font, text + final_score, white)
+    text_rect = text_surface.get_rect()
+    text_rect.midtop = (x, y)
+    surf.blit(text_surface, text_rect)
+
+class Scene(object):
+    # One screen of the game.  The SceneManager calls frame() once per frame
+    #   and switches to the scene whose name it returns ("quit" ends the game).
+    fps = 30 # Frame cap while this scene runs (0 = uncapped)
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def enter(self):
+        # Called every time the scene becomes the current one
+        pass
 
-def main():
-
-    w, h = SCREEN_SIZE
-    screen = pygame.display.set_mode(SCREEN_SIZE, 0, 32)
-    clock = pygame.time.Clock()
-    clock.get_time()
-    score_text = pygame.font.Font('assets/BebasNeue-Regular.ttf', 20)
-
-    background_image_file = "assets/space_background.png"
-    player_image_file = pygame.image.load("assets/spaceship.png").convert_alpha()
-    enemy_image =  pygame.image.load("assets/enemyship.png").convert_alpha()
-    laser_image = pygame.image.load("assets/laser.png").convert_alpha()
-
-    world = World(background_image_file)
-    player = Player(world, player_image_file)
-    projectile = Projectile(world, laser_image)
-    player.location = vec(w/2, h/2)
-    world.add_entity(player)
-    player_score = 0
-    pygame.display.set_caption("SpaceHunter")
-
-    aliens = pygame.sprite.Group()
-    bullets = pygame.sprite.Group()
-
-    alien_key_list = []
-
-    def end_scene(surf, score, text, x, y):
-        final_score = str(score)
-        font = pygame.font.Font('assets/BebasNeue-Regular.ttf', 20)
-        text_surface = font.render(text + final_score, True, white)
-        text_rect = text_surface.get_rect()
-        text_rect.midtop = (x, y)
-        surf.blit(text_surface, text_rect)
-
-    def add_aliens(world, alien_count, enemy_image):
-        # Create list of spawn zones for aliens
-        spawn_zones = []
-        # Randomly generated two spawn points for enemy ships
-        spawn1_coords = ([-50, random.randint(0, SCREEN_SIZE[1])])
-        spawn_zones.append(spawn1_coords)
-        spawn2_coords = (SCREEN_SIZE[0] + 50, random.randint(0, SCREEN_SIZE[1]))
-        spawn_zones.append(spawn2_coords)
-
-        # Randomly choose spawn point off the map for the enemey ships
-        alien_spawn = random.choice(spawn_zones)
-
-        for alien_no in range(alien_count):
-            alien = Alien(world, enemy_image)
-            aliens = pygame.sprite.Group(alien)
-            world.add_entity(alien)
-            alien_key = world.entity_id
-            alien_key_list.append(alien_key)
-            alien.location = vec(alien_spawn[0], alien_spawn[1])
-            alien.brain.set_state("exploring")
-
-    add_aliens(world, 30, enemy_image)
-
-    while True:
-        events = pygame.event.get()
-
-        time_passed = clock.tick(30)
-        # Passing keys and key events to player.
-        player.move(events, time_passed)
-        # Creating new list to hold projectiles for deletion
-        projectiles_list = []
-
-        world.render(screen)
-        world.process(time_passed)
+    def leave(self):
+        pass
 
-        for e in events:
-            if e.type == QUIT:
-                pygame.quit()
-                sys.exit()
-
-            if e.type == pygame.KEYDOWN:
-                if e.key == pygame.K_SPACE:
-                    # Creating instance of projectile and accessing projectile's functionality
-                    projectile_X, projectile_Y = player.heading
-                    projectile_x, projectile_y = player.location
-                    world.add_entity(projectile)
-                    bullets.add(projectile)
-                    key = projectile.id
-                    projectile.fire_laser(projectile_x, projectile_y,
-                        projectile_X, projectile_Y, time_passed)
-
-        # Adding projectile to deletion list if coordinates greater than screen
-        if projectile.location[0] < 0 or projectile.location[0] > (SCREEN_SIZE[0]):
-            projectiles_list.append(key)
-        elif projectile.location[1] < 0 or projectile.location[1] > (SCREEN_SIZE[1]):
-            projectiles_list.append(key)
-
-        # Iterate over the list and delete the corresponding key from world dict
-        #   Reduce the world entity iterator by 1.
-        for key in projectiles_list:
-            if key in world.entities:
-                world.entity_id -= 1
-                del world.entities[key]
-
-        for key in alien_key_list:
-            if key in world.entities:
-                alienObj = world.entities.get(key)
-
-                offset_x = int(alienObj.location.x) - int(projectile.location.x)
-                offset_y = int(alienObj.location.y) - int(projectile.location.y)
-
-                overlap = projectile.mask.overlap(alienObj.mask, (offset_x, offset_y))
-
-                if overlap:
-                    world.remove_entity(alienObj)
-                    player_score += 1
-                    add_aliens(world, random.randint(0, 2), enemy_image)
-                else:
-                    None
-
-        TextSurf, TextRect = text_objects(str(player_score), score_text, white)
-        TextRect.center = (SCREEN_SIZE[0]/2, 100)
-        screen.blit(TextSurf, TextRect)
+    def frame(self, events, time_passed):
+        return None
 
-        if player.health <= 0:
-            screen.fill(black)
-            end_scene(screen, str(player_score), "Game Over! Your Final Score: ", SCREEN_SIZE[0]/2, 100)
-            button(screen, score_text, "Play again?", 400, 525, 100, 50, white, grey, "play")
-            button(screen, score_text, "Quit", 700, 525, 100, 50, white, grey, "quit")
+    def entity_counts(self):
+        # Entities by name in the frame just drawn, for the profiler
+        return Counter()
 
-        pygame.display.update()
+class IntroScene(Scene):
 
-def game_intro():
+    def __init__(self, manager):
+        Scene.__init__(self, manager)
+        self.largeText = text_cache.font('assets/BebasNeue-Regular.ttf', 120)
+        self.mediumText = text_cache.font('assets/BebasNeue-Regular.ttf', 20)
+        self.smallText = text_cache.font('assets/BebasNeue-Regular.ttf', 15)
+        # Creating stars for the background of the introduction screen
+        self.stars = Starfield(SCREEN_SIZE, star_layers(MAX_STARS))
 
-    MAX_STARS = 250
-    STAR_SPEED = 1
-
-    def createStars(screenname):
-        # Create the starfield
-        global stars
-        stars = []
-        for i in range(MAX_STARS):
-            # Star represented in list as tuple of coordinates
-            star = [random.randrange(0, screen.get_width() -1),
-                    random.randrange(0, screen.get_height() - 1)]
-            stars.append(star)
-
-    def move_stars(screenname):
-        # Move and draw the stars in the given screen
-        global stars
-        for star in stars:
-            star[1] += STAR_SPEED
-            # If a star hits the bottom border of the screen, we
-            #   reposition it at the top of the screen with random x-coord
-            if star[1] >= screen.get_height():
-                star[1] = 0
-                star[0] = random.randrange(0, SCREEN_SIZE[0])
-            # Setting the color for each star
-            screenname.set_at(star, (white))
-
-    pygame.init()
-    screen = pygame.display.set_mode(SCREEN_SIZE, 0, 32)
-    largeText = pygame.font.Font('assets/BebasNeue-Regular.ttf', 120)
-    mediumText = pygame.font.Font('assets/BebasNeue-Regular.ttf', 20)
-    smallText = pygame.font.Font('assets/BebasNeue-Regular.ttf', 15)
-    # Creating stars for the background of the introduction screen
-    createStars(screen)
-
-    intro = True
-
-    while intro:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                quit()
+    def frame(self, events, time_passed):
+        screen = self.manager.screen
 
         introduction_1 = "You are the last battleship remaining, and the enemy is closing in..."
         introduction_2 = "Dodge the alienships with the arrow keys [UP + DOWN + LEFT + RIGHT] to control the steering of the ship"
         introduction_3 = "Hit the spacebar [SPACEBAR] to fire the ship's lasers"
 
         screen.fill(black)
-        TextSurf, TextRect = text_objects("Space Hunter", largeText, white)
-        directions1Surf, directions1Rect = text_objects(introduction_1, mediumText, white)
-        directions2Surf, directions2Rect = text_objects(introduction_2, smallText, white)
-        directions3Surf , directions3Rect = text_objects(introduction_3, smallText, white)
+        TextSurf, TextRect = text_objects("Space Hunter", self.largeText, white)
+        directions1Surf, directions1Rect = text_objects(introduction_1, self.mediumText, white)
+        directions2Surf, directions2Rect = text_objects(introduction_2, self.smallText, white)
+        directions3Surf , directions3Rect = text_objects(introduction_3, self.smallText, white)
         directions1Rect.center = (SCREEN_SIZE[0]/2, SCREEN_SIZE[1]/2 - 100)
         directions2Rect.center = (SCREEN_SIZE[0]/2, SCREEN_SIZE[1]/2 + 75)
         directions3Rect.center = (SCREEN_SIZE[0]/2, SCREEN_SIZE[1]/2 + 100)
@@ -621,13 +2501,344 @@ def game_intro():
         screen.blit(directions3Surf, directions3Rect)
         screen.blit(TextSurf, TextRect)
 
-        button(screen, smallText, "Start", 400, 525, 100, 50, white, grey, "play")
-        button(screen, smallText, "Quit", 700, 525, 100, 50, white, grey, "quit")
+        action = button(screen, self.smallText, "Start", 400, 525, 100, 50, white, grey, "game")
+        action = button(screen, self.smallText, "Quit", 700, 525, 100, 50, white, grey, "quit") or action
 
         # Calling stars for background imagery
-        move_stars(screen)
+        self.stars.update()
+        self.stars.draw(screen)
+
+        # Get the game's assets ready while the player reads the intro
+        startup.warm()
+
+        pygame.display.update()
+        startup.mark("intro_frame")
+        return action
+
+class GameScene(Scene):
+    # Plays one game.  The Simulation (and its world, projectile pool and
+    #   starfield) is created once and reset in place for every new game.
+
+    def __init__(self, manager):
+        Scene.__init__(self, manager)
+        self.score_text = text_cache.font('assets/BebasNeue-Regular.ttf', 20)
+        self.simulation = None
+        self.recorder = None
+
+    @property
+    def fps(self):
+        # Only fixed step and pipelined modes draw faster than the game is
+        #   simulated
+        return RENDER_FPS if FIXED_STEP or PIPELINE else 30
+
+    def enter(self):
+        startup.mark("game_start")
+        startup.finish()
+
+        # Every game gets a seed so its recording can be replayed exactly
+        seed = random.randrange(2**31)
+        if self.simulation is None:
+            self.simulation = Simulation("assets/space_background.png", seed=seed)
+            if GAME_STARS:
+                self.simulation.world.starfield = Starfield(SCREEN_SIZE, star_layers(GAME_STARS))
+            if PARTICLES and np is not None:
+                self.simulation.world.particles = ParticleSystem(SCREEN_SIZE)
+        else:
+            self.simulation.reset(seed)
+
+        if RECORD_PATH:
+            # A new game starts a new recording
+            self.recorder = InputRecorder(open(RECORD_PATH, "wb"), seed)
+            atexit.register(self.recorder.close)
+
+        self.score_rect = None # Where the score was drawn last frame
+        self.overlay_rect = None # Where the profiler overlay was drawn last frame
+        # Fixed step mode: time not simulated yet, and input waiting for a step
+        self.accumulator = 0.
+        self.pending_events = []
+
+        self.pipeline = None
+        if PIPELINE:
+            # The simulation thread gets a profiler of its own, the shared
+            #   one only times the drawing thread
+            self.simulation.profiler = FrameProfiler()
+            self.pipeline = SimulationPipeline(self.simulation, self.recorder)
+            self.pipeline.start()
+
+    def leave(self):
+        if self.pipeline is not None:
+            self.pipeline.stop()
+            self.pipeline = None
+            self.simulation.profiler = profiler
+        if self.recorder is not None:
+            self.recorder.close()
+            atexit.unregister(self.recorder.close)
+            self.recorder = None
+
+    def frame(self, events, time_passed):
+        if self.pipeline is not None:
+            return self.pipelined_frame(events)
+
+        screen = self.manager.screen
+        simulation = self.simulation
+        world = simulation.world
+
+        if simulation.game_over:
+            # Keep drawing until the player's explosion has played out
+            simulation.settle(time_passed)
+        elif FIXED_STEP:
+            self.fixed_steps(events, time_passed)
+        else:
+            if self.recorder is not None:
+                self.recorder.record(events, time_passed)
+            simulation.step(events, time_passed)
+        if FIXED_STEP:
+            # Draw between the last two steps by how far time has got
+            world.interpolate(self.accumulator / FIXED_DT)
+        player_score = simulation.score
+
+        TextSurf, TextRect = text_objects(str(player_score), self.score_text, white)
+        TextRect.center = (SCREEN_SIZE[0]/2, 100)
+
+        if DIRTY_RECTS:
+            # The score is redrawn every frame, so its area is always restored
+            if self.score_rect is not None:
+                world.invalidate(self.score_rect)
+            world.invalidate(TextRect)
+            if self.overlay_rect is not None:
+                world.invalidate(self.overlay_rect)
+            update_rects = world.render_dirty(screen)
+            update_rects.append(TextRect)
+            self.score_rect = TextRect
+        else:
+            world.render(screen)
+            update_rects = None
+        world.end_interpolation()
+        profiler.lap("render")
+        screen.blit(TextSurf, TextRect)
+
+        self.overlay_rect = None
+        if profiler.overlay:
+            self.overlay_rect = profiler.draw_overlay(screen, self.score_text)
+            if update_rects is not None:
+                update_rects.append(self.overlay_rect)
+        profiler.lap("hud")
+
+        if update_rects is None:
+            pygame.display.update()
+        else:
+            pygame.display.update(update_rects)
+        profiler.lap("display")
+        startup.mark("first_game_frame")
+
+        if simulation.finished:
+            self.manager.final_score = player_score
+            return "game_over"
+        return None
 
+    def pipelined_frame(self, events):
+        # Draw the newest frame the simulation thread has published
+        screen = self.manager.screen
+        self.pipeline.push(events)
+        frame = self.pipeline.latest
+
+        self.simulation.world.render_frame(screen, frame)
+        profiler.lap("render")
+        TextSurf, TextRect = text_objects(str(frame.score), self.score_text, white)
+        TextRect.center = (SCREEN_SIZE[0]/2, 100)
+        screen.blit(TextSurf, TextRect)
+        if profiler.overlay:
+            profiler.draw_overlay(screen, self.score_text)
+        profiler.lap("hud")
+        pygame.display.update()
+        profiler.lap("display")
+        startup.mark("first_game_frame")
+
+        if frame.finished:
+            self.manager.final_score = frame.score
+            return "game_over"
+        return None
+
+    def entity_counts(self):
+        if self.pipeline is not None:
+            # The world belongs to the simulation thread
+            return self.pipeline.latest.counts
+        return Counter(entity.name for entity in self.simulation.world.entities.values())
+
+    def fixed_steps(self, events, time_passed):
+        # Run as many FIXED_DT steps as the time passed covers, however fast
+        #   frames are drawn.  Input is held until the next step and goes to
+        #   that step only, so no key press is lost or applied twice.
+        simulation = self.simulation
+        self.pending_events.extend(events)
+        self.accumulator += time_passed
+        steps = 0
+        while self.accumulator >= FIXED_DT and not simulation.game_over:
+            if steps == MAX_STEPS_PER_FRAME:
+                # Too far behind to catch up, drop the time instead of
+                #   slowing every following frame down as well
+                self.accumulator = 0.
+                break
+            simulation.world.remember()
+            if self.recorder is not None:
+                self.recorder.record(self.pending_events, FIXED_DT)
+            simulation.step(self.pending_events, FIXED_DT)
+            self.pending_events = []
+            self.accumulator -= FIXED_DT
+            steps += 1
+
+class GameOverScene(Scene):
+
+    def __init__(self, manager):
+        Scene.__init__(self, manager)
+        self.score_text = text_cache.font('assets/BebasNeue-Regular.ttf', 20)
+
+    def frame(self, events, time_passed):
+        screen = self.manager.screen
+        screen.fill(black)
+        end_scene(screen, str(self.manager.final_score), "Game Over! Your Final Score: ", SCREEN_SIZE[0]/2, 100)
+        action = button(screen, self.score_text, "Play again?", 400, 525, 100, 50, white, grey, "game")
+        action = button(screen, self.score_text, "Quit", 700, 525, 100, 50, white, grey, "quit") or action
         pygame.display.update()
+        return action
+
+class SceneManager(object):
+    # Runs the intro, gameplay and game over scenes in one top-level loop.
+    #   Scenes are created once, so fonts, surfaces, masks and the world are
+    #   reused by every game instead of being reloaded on each restart.
+    def __init__(self):
+        # Decoding starts before anything else so it overlaps the display setup
+        startup.begin()
+        pygame.init()
+        self.screen = pygame.display.set_mode(SCREEN_SIZE, 0, 32)
+        pygame.display.set_caption("SpaceHunter")
+        startup.mark("display")
+        self.clock = pygame.time.Clock()
+        self.final_score = 0
+        self.scenes = {"intro": IntroScene(self), "game": GameScene(self),
+            "game_over": GameOverScene(self)}
+        self.scene = None
+
+    def switch(self, name):
+        if self.scene is not None:
+            self.scene.leave()
+        self.scene = self.scenes[name]
+        self.scene.enter()
+
+    def run(self, start="intro"):
+        self.switch(start)
+        while True:
+            profiler.begin_frame()
+            events = pygame.event.get()
+            profiler.lap("events")
+
+            time_passed = self.clock.tick(self.scene.fps)
+            profiler.lap("wait")
+
+            next_scene = None
+            for e in events:
+                if e.type == QUIT:
+                    next_scene = "quit"
+                if e.type == pygame.KEYDOWN and e.key == pygame.K_F3:
+                    # Toggle the profiler overlay (profiling itself turns on with it)
+                    profiler.overlay = not profiler.overlay
+                    profiler.enabled = profiler.enabled or profiler.overlay
+
+            if next_scene is None:
+                next_scene = self.scene.frame(events, time_passed)
+            profiler.end_frame(self.scene.entity_counts() if profiler.active else None)
+
+            if next_scene == "quit":
+                self.scene.leave()
+                pygame.quit()
+                return
+            if next_scene is not None:
+                self.switch(next_scene)
+
+def main(start="intro"):
+    # Play the game, starting from the intro screen (or straight into "game")
+    SceneManager().run(start)
+
+def game_intro():
+    main("intro")
+
+def startup_check(budget=STARTUP_BUDGET):
+    # Launch the game as an impatient player would, clicking Start on the
+    #   first intro frame, and time the first frame of gameplay against the
+    #   budget.  Returns (milliseconds since launch, within budget).
+    manager = SceneManager()
+    manager.switch("intro")
+    manager.scene.frame([], 0)
+    manager.switch("game")
+    manager.scene.frame([], FIXED_DT)
+    manager.scene.leave()
+    pygame.quit()
+    elapsed = startup.marks["first_game_frame"]
+    return elapsed, elapsed <= budget
 
 if __name__ == "__main__":
-    game_intro()
+    parser = argparse.ArgumentParser(description="Space Hunter")
+    parser.add_argument("--headless", type=int, metavar="FRAMES",
+        help="simulate one game with a random pilot and no display, then print its result")
+    parser.add_argument("--seed", type=int, help="random seed for headless games")
+    parser.add_argument("--dirty-rects", action="store_true",
+        help="only redraw and update the parts of the screen that changed")
+    parser.add_argument("--stars", type=int, default=0, metavar="COUNT",
+        help="draw a starfield of COUNT stars over the in-game background")
+    parser.add_argument("--intro-stars", type=int, default=MAX_STARS, metavar="COUNT",
+        help="stars on the title screen (default: %(default)s)")
+    parser.add_argument("--no-particles", action="store_true",
+        help="turn off explosion and thruster particles")
+    parser.add_argument("--profile", metavar="PATH",
+        help="time every frame phase and write the last frames to PATH (.csv or .json) on exit")
+    parser.add_argument("--compact-aliens", action="store_true",
+        help="use slotted aliens with shared states in headless games")
+    parser.add_argument("--memory-report", type=int, metavar="COUNT",
+        help="print the bytes per alien of each alien representation, measured over COUNT aliens")
+    parser.add_argument("--record", metavar="PATH", help="record the game's input to PATH")
+    parser.add_argument("--replay", metavar="PATH",
+        help="play a recording back without a display and print its result")
+    parser.add_argument("--fixed-step", action="store_true",
+        help="simulate at a fixed 30 steps per second and interpolate the frames drawn in between")
+    parser.add_argument("--pipeline", action="store_true",
+        help="simulate at a fixed 30 steps per second on a thread of its own while drawing on the main thread")
+    parser.add_argument("--fps", type=int, default=RENDER_FPS,
+        help="frame cap with --fixed-step or --pipeline, 0 for uncapped (default: %(default)s)")
+    parser.add_argument("--startup-report", action="store_true",
+        help="print how long each startup step took, from launch, and the asset cache counters on exit")
+    parser.add_argument("--startup-budget", type=float, nargs="?", const=STARTUP_BUDGET, metavar="MS",
+        help="start a game straight away, then fail if its first frame took longer than MS "
+            "(default: %(const)s) from launch")
+    args = parser.parse_args()
+    RECORD_PATH = args.record
+    if args.profile:
+        profiler.enabled = True
+        atexit.register(profiler.dump, args.profile)
+    if args.startup_report or args.startup_budget is not None:
+        atexit.register(lambda: print(startup.report()))
+    DIRTY_RECTS = args.dirty_rects
+    FIXED_STEP = args.fixed_step
+    PIPELINE = args.pipeline
+    RENDER_FPS = args.fps
+    GAME_STARS = args.stars
+    PARTICLES = not args.no_particles
+    MAX_STARS = args.intro_stars
+
+    if args.memory_report:
+        print(json.dumps(alien_memory_report(args.memory_report)))
+    elif args.replay:
+        try:
+            result = replay(args.replay)
+        except ValueError as e:
+            sys.exit(str(e))
+        print(json.dumps(result))
+    elif args.startup_budget is not None:
+        elapsed, within = startup_check(args.startup_budget)
+        print("first gameplay frame after %.1f ms (budget %.1f ms)" % (elapsed, args.startup_budget))
+        if not within:
+            sys.exit(1)
+    elif args.headless:
+        print(json.dumps(run_headless(args.headless, args.seed, random_pilot(args.seed),
+            compact_aliens=args.compact_aliens)))
+    else:
+        main()
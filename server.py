@@ -0,0 +1,647 @@
+"""
+Space Hunter multiplayer.
+
+An authoritative server runs one World with any number of players and takes every player's input over UDP.  Each tick
+it sends every client a snapshot of the world, quantized to fixed point and delta-compressed against the last snapshot
+that client acknowledged.  Clients predict their own ship from their inputs straight away and reconcile with the
+server's state when it arrives.  Bot clients make the whole thing testable on one machine, and report bandwidth,
+input-to-confirmation latency and prediction corrections per client.
+
+    python server.py --bots 4 --seconds 10
+    python server.py --serve --port 7777
+    python server.py --connect 192.168.1.5:7777 --bots 2 --seconds 30
+    python server.py --play 192.168.1.5:7777
+
+"""
+
+import argparse
+import math
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import pygame
+
+import main
+
+PORT = 7777
+TICK_MS = main.FIXED_DT # Server simulation step, and one client input per step
+INPUT_REDUNDANCY = 8 # Latest inputs repeated in every input packet, against loss
+SNAPSHOT_HISTORY = 32 # Snapshots kept per client as possible delta baselines
+CLIENT_TIMEOUT = 5. # Seconds without a packet before a client is dropped
+RESPAWN_MS = 3000. # Time a dead player waits before flying again
+MAX_INPUTS_PER_TICK = 4 # Queued inputs a client may have applied in one tick
+MAX_DATAGRAM = 65507
+
+# Quantization: positions in quarter pixels from -1024, rotation in 1/65536 turns
+POSITION_SCALE = 4.
+POSITION_OFFSET = 1024.
+ROTATION_SCALE = 65536 / 360.
+
+# Input key bits (fire is pressed for one input only)
+KEY_BITS = ((pygame.K_LEFT, 1), (pygame.K_RIGHT, 2), (pygame.K_UP, 4), (pygame.K_DOWN, 8))
+FIRE_BIT = 16
+
+# Packets.  Client to server: join, inputs, leave.  Server to client: welcome, snapshot.
+JOIN = b"J"
+LEAVE = b"L"
+WELCOME = struct.Struct("<cI") # b"W", player handle
+INPUT_HEADER = struct.Struct("<cIB") # b"I", newest snapshot tick received, input count
+INPUT = struct.Struct("<IB") # input sequence number, key bits
+SNAPSHOT_HEADER = struct.Struct("<cIIHH") # b"S", tick, baseline tick (0 = full), removed, changed
+OWN_STATE = struct.Struct("<I4fbbbh") # last input applied, x, y, rotation, speed,
+    # acceleration / 10, movement direction, rotation direction, health
+REMOVED = struct.Struct("<I") # handle
+CHANGED = struct.Struct("<IB") # handle, mask of the fields that follow
+FIELDS = tuple(struct.Struct("<" + code) for code in "BHHHh") # type, x, y, rotation, health
+
+def quantize(entity):
+    # (type, x, y, rotation, health) as sent over the network
+    x, y = entity.location
+    return (main.SNAPSHOT_TYPES.index(entity.name) + 1,
+        int(min(max((x + POSITION_OFFSET) * POSITION_SCALE, 0), 0xffff)),
+        int(min(max((y + POSITION_OFFSET) * POSITION_SCALE, 0), 0xffff)),
+        int(getattr(entity, "rotation", 0) % 360 * ROTATION_SCALE) & 0xffff,
+        getattr(entity, "health", 0))
+
+def dequantize(state):
+    # (name, x, y, rotation, health) from a quantized state
+    kind, x, y, rotation, health = state
+    return (main.SNAPSHOT_TYPES[kind - 1], x / POSITION_SCALE - POSITION_OFFSET,
+        y / POSITION_SCALE - POSITION_OFFSET, rotation / ROTATION_SCALE, health)
+
+def key_events(previous, keys):
+    # The key events that turn held keys `previous` into `keys`; Player.move
+    #   is driven by events, on the server and in client prediction alike
+    events = []
+    for key, bit in KEY_BITS:
+        if keys & bit and not previous & bit:
+            events.append(pygame.event.Event(pygame.KEYDOWN, key=key))
+        elif previous & bit and not keys & bit:
+            events.append(pygame.event.Event(pygame.KEYUP, key=key))
+    if keys & FIRE_BIT:
+        events.append(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_SPACE))
+    return events
+
+def encode_snapshot(tick, baseline_tick, baseline, states, own):
+    # Entities gone since the baseline, then only the changed fields of the
+    #   rest (every field for new ones)
+    removed = [handle for handle in baseline if handle not in states]
+    changed = []
+    for handle, state in states.items():
+        old = baseline.get(handle)
+        mask = 0
+        fields = []
+        for i, value in enumerate(state):
+            if old is None or old[i] != value:
+                mask |= 1 << i
+                fields.append(FIELDS[i].pack(value))
+        if mask:
+            changed.append(CHANGED.pack(handle, mask) + b"".join(fields))
+    return b"".join([SNAPSHOT_HEADER.pack(b"S", tick, baseline_tick, len(removed), len(changed)), own]
+        + [REMOVED.pack(handle) for handle in removed] + changed)
+
+def decode_snapshot(data, baselines):
+    # Return (tick, own state, states), or None when the baseline it was
+    #   encoded against is no longer known here.  Raises struct.error or
+    #   ValueError for a packet that isn't a whole, valid snapshot.
+    kind, tick, baseline_tick, removed, changed = SNAPSHOT_HEADER.unpack_from(data, 0)
+    if baseline_tick:
+        if baseline_tick not in baselines:
+            return None
+        states = dict(baselines[baseline_tick])
+    else:
+        states = {}
+    offset = SNAPSHOT_HEADER.size
+    own = OWN_STATE.unpack_from(data, offset)
+    offset += OWN_STATE.size
+    for i in range(removed):
+        states.pop(REMOVED.unpack_from(data, offset)[0], None)
+        offset += REMOVED.size
+    for i in range(changed):
+        handle, mask = CHANGED.unpack_from(data, offset)
+        offset += CHANGED.size
+        state = list(states.get(handle, (0, 0, 0, 0, 0)))
+        for field, value in enumerate(FIELDS):
+            if mask & 1 << field:
+                state[field] = value.unpack_from(data, offset)[0]
+                offset += value.size
+        if not 1 <= state[0] <= len(main.SNAPSHOT_TYPES):
+            raise ValueError("Unknown entity type %d in snapshot" % state[0])
+        states[handle] = tuple(state)
+    return tick, own, states
+
+def percentile(values, p):
+    if not values:
+        return 0.
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(math.ceil(p / 100. * len(ordered))) - 1)]
+
+class ServerSimulation(main.Simulation):
+    # A Simulation with one Player per connected client instead of a single
+    #   local one.  Aliens hunt whichever player is closest.
+    def reset(self, seed=None):
+        main.Simulation.reset(self, seed)
+        # Players join over the network instead
+        self.world.remove_entity(self.player)
+        self.players = {} # handle -> Player
+        self.dead_time = {} # handle -> milliseconds since the player died
+
+    def join(self):
+        player = main.Player(self.world, main.assets.image("assets/spaceship.png"))
+        player.max_speed = self.tuning.player_max_speed
+        self.respawn(player)
+        self.world.add_entity(player)
+        self.players[player.id] = player
+        return player.id
+
+    def leave(self, handle):
+        player = self.players.pop(handle, None)
+        if player is not None:
+            self.world.despawn(player)
+            self.dead_time.pop(handle, None)
+
+    def respawn(self, player):
+        player.health = self.tuning.player_health
+        player.image = main.assets.image("assets/spaceship.png")
+        player.speed = 0
+        player.location = main.vec(random.randint(100, main.SCREEN_SIZE[0] - 100),
+            random.randint(100, main.SCREEN_SIZE[1] - 100))
+        player.update_frame()
+
+    @property
+    def game_over(self):
+        # The server keeps running however many players are down
+        return False
+
+    def step(self, inputs, time_passed):
+        # inputs: player handle -> list of key events, one per client input.
+        #   A player only moves for the inputs it sent, each one step long,
+        #   exactly as the client predicted it.
+        for handle, player in self.players.items():
+            if player.health <= 0:
+                # Dead players wait, then come back with full health
+                self.dead_time[handle] = self.dead_time.get(handle, 0) + time_passed
+                if self.dead_time[handle] >= RESPAWN_MS:
+                    del self.dead_time[handle]
+                    self.respawn(player)
+                continue
+            for events in inputs.get(handle, ()):
+                player.move(events, time_passed)
+                self.fire(player, events)
+        self.world.process(time_passed)
+        self.projectiles.despawn_offscreen()
+        self.collide()
+        self.world.sync()
+        self.frame += 1
+        self.time += time_passed
+
+class ClientSlot(object):
+    # What the server knows about one connected client
+    def __init__(self, handle):
+        self.handle = handle
+        self.inputs = {} # sequence -> key bits, not applied yet
+        self.last_sequence = 0 # Newest input applied
+        self.keys = 0 # Keys held after the newest applied input
+        self.acked = 0 # Newest snapshot tick the client has
+        self.history = OrderedDict() # tick -> quantized states sent at that tick
+        self.last_heard = time.perf_counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.full_snapshots = 0
+        self.delta_snapshots = 0
+
+class Server(object):
+    # Runs the simulation at a fixed tick rate and talks to clients over one
+    #   non-blocking UDP socket
+    def __init__(self, host="0.0.0.0", port=PORT, seed=None, alien_count=None):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.socket.setblocking(False)
+        self.address = self.socket.getsockname()
+        self.simulation = ServerSimulation(seed=seed, alien_count=alien_count)
+        self.clients = {} # address -> ClientSlot
+        self.tick_count = 0
+        self.tick_times = [] # Seconds spent simulating and sending, per tick
+
+    def receive(self):
+        while True:
+            try:
+                data, address = self.socket.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionResetError:
+                # A client's port went away (reported on some platforms)
+                continue
+            try:
+                self.handle_packet(data, address)
+            except struct.error:
+                # Anything can arrive on the port; a bad packet is dropped,
+                #   never allowed to stop the server
+                continue
+
+    def handle_packet(self, data, address):
+        kind = data[:1]
+        client = self.clients.get(address)
+        if kind == JOIN:
+            if client is None:
+                client = self.clients[address] = ClientSlot(self.simulation.join())
+            # Welcome again if the first one was lost
+            self.socket.sendto(WELCOME.pack(b"W", client.handle), address)
+        elif client is None:
+            return
+        elif kind == LEAVE:
+            self.simulation.leave(client.handle)
+            del self.clients[address]
+            return
+        elif kind == b"I":
+            if len(data) < INPUT_HEADER.size:
+                return
+            tick, count = INPUT_HEADER.unpack_from(data, 0)[1:]
+            if len(data) < INPUT_HEADER.size + count * INPUT.size:
+                return
+            client.acked = max(client.acked, tick)
+            for i in range(count):
+                sequence, keys = INPUT.unpack_from(data, INPUT_HEADER.size + i * INPUT.size)
+                if sequence > client.last_sequence:
+                    client.inputs[sequence] = keys
+        client.last_heard = time.perf_counter()
+        client.bytes_received += len(data)
+
+    def tick(self):
+        started = time.perf_counter()
+        self.receive()
+
+        # Every input that arrived (in order) moves its client's player once
+        inputs = {}
+        for address, client in list(self.clients.items()):
+            if started - client.last_heard > CLIENT_TIMEOUT:
+                self.simulation.leave(client.handle)
+                del self.clients[address]
+                continue
+            applied = inputs[client.handle] = []
+            for sequence in sorted(client.inputs)[:MAX_INPUTS_PER_TICK]:
+                keys = client.inputs.pop(sequence)
+                applied.append(key_events(client.keys, keys))
+                client.keys = keys & ~FIRE_BIT
+                client.last_sequence = sequence
+
+        self.simulation.step(inputs, TICK_MS)
+        self.tick_count += 1
+        self.send_snapshots()
+        self.tick_times.append(time.perf_counter() - started)
+
+    def send_snapshots(self):
+        tick = self.tick_count
+        states = dict((entity.id, quantize(entity))
+            for entity in self.simulation.world.entities.values())
+        for address, client in self.clients.items():
+            player = self.simulation.players[client.handle]
+            x, y = player.location
+            own = OWN_STATE.pack(client.last_sequence, x, y, player.rotation, player.speed,
+                player.acceleration // 10, player.movement_direction, player.rotation_direction,
+                player.health)
+            # Delta against the newest snapshot the client has, if still kept
+            baseline_tick = client.acked if client.acked in client.history else 0
+            baseline = client.history[baseline_tick] if baseline_tick else {}
+            packet = encode_snapshot(tick, baseline_tick, baseline, states, own)
+            if baseline_tick:
+                client.delta_snapshots += 1
+            else:
+                client.full_snapshots += 1
+
+            client.history[tick] = states
+            while len(client.history) > SNAPSHOT_HISTORY:
+                client.history.popitem(last=False)
+            self.socket.sendto(packet, address)
+            client.bytes_sent += len(packet)
+
+    def serve(self, stop=None, seconds=None):
+        # Tick at the fixed rate until `stop` is set or time runs out
+        started = time.perf_counter()
+        next_tick = started
+        while not (stop is not None and stop.is_set()):
+            if seconds is not None and time.perf_counter() - started >= seconds:
+                break
+            self.tick()
+            next_tick += TICK_MS / 1000.
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Fell behind; don't try to catch up on the lost ticks
+                next_tick = time.perf_counter()
+        self.socket.close()
+
+    def stats(self):
+        ticks = [t * 1000 for t in self.tick_times]
+        return {"ticks": self.tick_count, "tick_mean_ms": sum(ticks) / max(len(ticks), 1),
+            "tick_p95_ms": percentile(ticks, 95), "clients": len(self.clients),
+            "entities": len(self.simulation.world.entities), "score": self.simulation.score}
+
+class Client(object):
+    # One player's connection.  Every tick the client sends its newest inputs
+    #   and applies the latest one to its own Player straight away.  When a
+    #   snapshot says which input the server has applied, the player is put
+    #   where the server has it and the inputs since are played again.
+    def __init__(self, address, loss=0., seed=None):
+        self.address = address
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.loss = loss # Fraction of incoming packets to drop, for testing
+        self.rng = random.Random(seed)
+        self.handle = None
+        self.world = main.World()
+        self.player = main.Player(self.world, main.assets.image("assets/spaceship.png"))
+        self.sequence = 0
+        self.keys = 0
+        self.pending = [] # (sequence, key events) not confirmed by the server yet
+        self.sent_inputs = [] # (sequence, key bits), newest last
+        self.sent_time = {} # sequence -> when it was sent
+        self.snapshots = OrderedDict() # tick -> quantized states, as delta baselines
+        self.tick = 0 # Newest snapshot received
+        self.states = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.snapshots_received = 0
+        self.snapshots_dropped = 0 # Lost on purpose, or their baseline was gone
+        self.latencies = [] # Input sent to server confirmation, ms
+        self.corrections = [] # Distance between prediction and server, px
+
+    def send(self, data):
+        self.socket.sendto(data, self.address)
+        self.bytes_sent += len(data)
+
+    def connect(self, timeout=5.):
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            self.send(JOIN)
+            time.sleep(0.05)
+            self.receive()
+            if self.handle is not None:
+                self.player.max_speed = main.Tuning().player_max_speed
+                return self.handle
+        raise IOError("No answer from the server at %s:%d" % self.address)
+
+    def receive(self):
+        while True:
+            try:
+                data, address = self.socket.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError, ConnectionResetError):
+                return
+            self.bytes_received += len(data)
+            if data[:1] == b"W":
+                if len(data) == WELCOME.size:
+                    self.handle = WELCOME.unpack(data)[1]
+            elif data[:1] == b"S":
+                if self.rng.random() < self.loss:
+                    self.snapshots_dropped += 1
+                    continue
+                self.apply_snapshot(data)
+
+    def apply_snapshot(self, data):
+        try:
+            decoded = decode_snapshot(data, self.snapshots)
+        except (struct.error, ValueError):
+            # Truncated or not a snapshot at all
+            decoded = None
+        if decoded is None:
+            self.snapshots_dropped += 1
+            return
+        tick, own, states = decoded
+        if tick <= self.tick:
+            return # Arrived out of order
+        self.snapshots_received += 1
+        self.tick = tick
+        self.states = states
+        self.snapshots[tick] = states
+        while len(self.snapshots) > SNAPSHOT_HISTORY:
+            self.snapshots.popitem(last=False)
+        self.reconcile(own)
+
+    def reconcile(self, own):
+        (sequence, x, y, rotation, speed, acceleration, movement_direction,
+            rotation_direction, health) = own
+        sent = self.sent_time.pop(sequence, None)
+        if sent is not None:
+            self.latencies.append((time.perf_counter() - sent) * 1000)
+        for old in [s for s in self.sent_time if s < sequence]:
+            del self.sent_time[old]
+
+        predicted = main.vec(self.player.location)
+        alive = self.player.health > 0
+        player = self.player
+        player.location = main.vec(x, y)
+        player.rotation = rotation
+        player.speed = speed
+        player.acceleration = acceleration * 10
+        player.movement_direction = movement_direction
+        player.rotation_direction = rotation_direction
+        player.health = health
+        # Play the inputs the server hasn't applied yet on top of its state
+        self.pending = [(s, events) for s, events in self.pending if s > sequence]
+        if health > 0:
+            for s, events in self.pending:
+                player.move(events, TICK_MS)
+        # The first snapshot and respawns move the player on purpose
+        if self.snapshots_received > 1 and alive == (health > 0):
+            self.corrections.append(predicted.distance_to(player.location))
+
+    def step(self, keys):
+        # Send this tick's keys (with the last few, against loss) and predict
+        self.receive()
+        self.sequence += 1
+        events = key_events(self.keys, keys)
+        self.keys = keys & ~FIRE_BIT
+        if self.player.health > 0:
+            self.player.move(events, TICK_MS)
+        self.pending.append((self.sequence, events))
+
+        self.sent_inputs.append((self.sequence, keys))
+        del self.sent_inputs[:-INPUT_REDUNDANCY]
+        self.sent_time[self.sequence] = time.perf_counter()
+        packet = INPUT_HEADER.pack(b"I", self.tick, len(self.sent_inputs)) + b"".join(
+            INPUT.pack(sequence, bits) for sequence, bits in self.sent_inputs)
+        self.send(packet)
+
+    def close(self):
+        try:
+            self.send(LEAVE)
+        except OSError:
+            pass
+        self.socket.close()
+
+    def stats(self, seconds):
+        return {"handle": self.handle, "snapshots": self.snapshots_received,
+            "dropped": self.snapshots_dropped,
+            "down_kbps": self.bytes_received * 8 / 1000. / seconds,
+            "up_kbps": self.bytes_sent * 8 / 1000. / seconds,
+            "bytes_per_snapshot": self.bytes_received / float(max(self.snapshots_received, 1)),
+            "latency_mean_ms": sum(self.latencies) / max(len(self.latencies), 1),
+            "latency_p95_ms": percentile(self.latencies, 95),
+            "correction_mean_px": sum(self.corrections) / max(len(self.corrections), 1),
+            "correction_max_px": max(self.corrections or [0.])}
+
+def bot_keys(rng):
+    # Random steering that changes every second or so, firing often
+    keys = 0
+    def next_keys():
+        nonlocal keys
+        if rng.random() < 0.03:
+            keys = rng.choice((0, 1, 2, 4, 4 | 1, 4 | 2, 8))
+        return keys | (FIRE_BIT if rng.random() < 0.2 else 0)
+    return next_keys
+
+def run_bot(address, seconds, seed=None, loss=0., results=None):
+    # Play for `seconds` at the tick rate and return the client's stats
+    client = Client(address, loss, seed)
+    client.connect()
+    keys = bot_keys(random.Random(seed))
+    started = time.perf_counter()
+    next_tick = started
+    while time.perf_counter() - started < seconds:
+        client.step(keys())
+        next_tick += TICK_MS / 1000.
+        delay = next_tick - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    # Collect the last snapshots in flight
+    time.sleep(0.1)
+    client.receive()
+    client.close()
+    stats = client.stats(seconds)
+    if results is not None:
+        results.append(stats)
+    return stats
+
+def local_test(bots, seconds, port=0, loss=0., seed=0, alien_count=None):
+    # A server and `bots` bot clients on localhost, each in its own thread
+    main.warm_assets()
+    server = Server("127.0.0.1", port, seed=seed, alien_count=alien_count)
+    stop = threading.Event()
+    server_thread = threading.Thread(target=server.serve, args=(stop,), name="server")
+    server_thread.start()
+
+    results = []
+    threads = [threading.Thread(target=run_bot, args=(server.address, seconds, seed + i + 1, loss, results),
+        name="bot-%d" % i) for i in range(bots)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop.set()
+    server_thread.join()
+    return server.stats(), results
+
+def play(address):
+    # Fly one ship on a server, drawing the latest snapshot with the local
+    #   player where prediction has it
+    pygame.init()
+    screen = pygame.display.set_mode(main.SCREEN_SIZE, 0, 32)
+    pygame.display.set_caption("SpaceHunter")
+    client = Client(address)
+    client.connect()
+    background = main.assets.image("assets/space_background.png", alpha=False)
+    images = {"alien": main.assets.image("assets/enemyship.png"),
+        "projectile": main.assets.image("assets/laser.png")}
+    atlas = main.assets.atlas(main.assets.image("assets/spaceship.png"))
+    dead_atlas = main.assets.atlas(main.assets.image("assets/explosion.png"))
+    font = main.text_cache.font('assets/BebasNeue-Regular.ttf', 20)
+    clock = pygame.time.Clock()
+    keys = 0
+    while True:
+        fire = False
+        for e in pygame.event.get():
+            if e.type == pygame.QUIT:
+                client.close()
+                pygame.quit()
+                return
+            if e.type in (pygame.KEYDOWN, pygame.KEYUP):
+                for key, bit in KEY_BITS:
+                    if e.key == key:
+                        keys = keys | bit if e.type == pygame.KEYDOWN else keys & ~bit
+                if e.type == pygame.KEYDOWN and e.key == pygame.K_SPACE:
+                    fire = True
+        client.step(keys | (FIRE_BIT if fire else 0))
+
+        screen.blit(background, (0, 0))
+        sprites = []
+        for handle, state in client.states.items():
+            name, x, y, rotation, health = dequantize(state)
+            if name == "player":
+                if handle == client.handle:
+                    continue
+                image, mask, (offset_x, offset_y) = (atlas if health > 0 else dead_atlas).get(rotation)
+                sprites.append((image, (x + offset_x, y + offset_y)))
+            else:
+                image = images[name]
+                half_w, half_h = main.assets.extent(image)
+                sprites.append((image, (x - half_w, y - half_h)))
+        player = client.player
+        image, mask, (offset_x, offset_y) = (atlas if player.health > 0 else dead_atlas).get(player.rotation)
+        sprites.append((image, (player.location.x + offset_x, player.location.y + offset_y)))
+        screen.blits(sprites, False)
+        text = main.text_cache.render(font, "%d players  %.0f ms" % (
+            sum(1 for state in client.states.values() if state[0] == 1),
+            sum(client.latencies[-30:]) / max(len(client.latencies[-30:]), 1)), main.white)
+        screen.blit(text, (10, 10))
+        pygame.display.update()
+        clock.tick(1000. / TICK_MS)
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+def print_stats(server_stats, results):
+    if server_stats is not None:
+        print("server: %(ticks)d ticks, %(tick_mean_ms).2f ms mean (p95 %(tick_p95_ms).2f ms), "
+            "%(entities)d entities, score %(score)d" % server_stats)
+    for stats in sorted(results, key=lambda stats: stats["handle"]):
+        print("client %(handle)d: %(snapshots)d snapshots (%(dropped)d dropped), "
+            "down %(down_kbps).1f kbit/s, up %(up_kbps).1f kbit/s, %(bytes_per_snapshot).0f B/snapshot, "
+            "latency %(latency_mean_ms).1f ms (p95 %(latency_p95_ms).1f ms), "
+            "correction %(correction_mean_px).2f px (max %(correction_max_px).1f px)" % stats)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Space Hunter multiplayer")
+    parser.add_argument("--serve", action="store_true", help="run a server until interrupted")
+    parser.add_argument("--port", type=int, default=PORT, help="server port (default: %(default)s)")
+    parser.add_argument("--connect", type=parse_address, metavar="HOST:PORT",
+        help="run the bots against this server instead of a local one")
+    parser.add_argument("--play", type=parse_address, metavar="HOST:PORT", help="join a server and play")
+    parser.add_argument("--bots", type=int, default=4, help="bot clients to run (default: %(default)s)")
+    parser.add_argument("--seconds", type=float, default=10., help="how long the bots play")
+    parser.add_argument("--loss", type=float, default=0., help="fraction of snapshots each bot drops")
+    parser.add_argument("--aliens", type=int, help="aliens in the world")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    if args.play:
+        play(args.play)
+    else:
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        if args.serve:
+            main.warm_assets()
+            server = Server(port=args.port, seed=args.seed, alien_count=args.aliens)
+            print("serving on %s:%d" % server.address)
+            try:
+                server.serve()
+            except KeyboardInterrupt:
+                pass
+        elif args.connect:
+            main.warm_assets()
+            results = []
+            threads = [threading.Thread(target=run_bot, args=(args.connect, args.seconds, args.seed + i + 1,
+                args.loss, results)) for i in range(args.bots)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            print_stats(None, results)
+        else:
+            server_stats, results = local_test(args.bots, args.seconds, 0, args.loss, args.seed, args.aliens)
+            print_stats(server_stats, results)
@@ -0,0 +1,88 @@
+"""
+Multiplayer robustness: junk datagrams on the server's port are dropped and
+never stop it from ticking, and a client drops junk just the same.
+
+    python -m pytest tests
+"""
+
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import socket
+import sys
+import threading
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import main
+import server
+
+# Short, truncated and malformed packets of every kind
+JUNK = (b"", b"I", b"I\x01", b"I\x00\x00\x00\x00\x05", b"I\x00\x00\x00\x00\x05\x01\x00", b"J\x00", b"L\xff",
+    b"W", b"S", b"S\x01\x00\x00\x00", b"\xff" * 40, os.urandom(300))
+
+
+class JunkPacketTest(unittest.TestCase):
+
+    def setUp(self):
+        main.warm_assets()
+        self.server = server.Server("127.0.0.1", 0, seed=1)
+        self.stop = threading.Event()
+        self.errors = []
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def serve(self):
+        try:
+            self.server.serve(self.stop)
+        except Exception as e:
+            self.errors.append(e)
+
+    def tearDown(self):
+        self.stop.set()
+        self.thread.join()
+
+    def join(self, sock):
+        # Join from this socket so its packets reach the input parser
+        sock.settimeout(2.)
+        sock.sendto(server.JOIN, self.server.address)
+        while sock.recvfrom(server.MAX_DATAGRAM)[0][:1] != b"W":
+            pass
+
+    def test_server_keeps_ticking(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.join(sock)
+        for data in JUNK:
+            sock.sendto(data, self.server.address)
+        ticks = self.server.tick_count
+        time.sleep(0.3)
+        sock.close()
+        self.assertEqual(self.errors, [])
+        self.assertTrue(self.thread.is_alive())
+        self.assertGreater(self.server.tick_count, ticks)
+
+    def test_client_drops_junk(self):
+        client = server.Client(self.server.address, seed=1)
+        client.connect()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for data in JUNK:
+            if data:
+                sock.sendto(data, ("127.0.0.1", client.socket.getsockname()[1]))
+        sock.close()
+        time.sleep(0.1)
+        client.step(0)
+        time.sleep(0.1)
+        client.step(0)
+        client.close()
+        self.assertIsNotNone(client.handle)
+        self.assertGreater(client.snapshots_received, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
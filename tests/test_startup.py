@@ -0,0 +1,34 @@
+"""
+Startup budget: a fresh game process must reach its first frame of gameplay
+within main.STARTUP_BUDGET milliseconds of launch.
+
+    python -m pytest tests
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Launch, click Start on the first intro frame, draw one game frame and print
+#   the first_game_frame mark and the budget
+CHECK = "import main; elapsed, within = main.startup_check(); print(elapsed, main.STARTUP_BUDGET)"
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_first_game_frame_within_budget(self):
+        # A process of its own, so nothing is decoded or cached beforehand
+        env = dict(os.environ, SDL_VIDEODRIVER="dummy", SDL_AUDIODRIVER="dummy",
+            PYGAME_HIDE_SUPPORT_PROMPT="1")
+        output = subprocess.check_output([sys.executable, "-c", CHECK], cwd=ROOT, env=env,
+            universal_newlines=True)
+        elapsed, budget = (float(value) for value in output.split()[-2:])
+        self.assertLessEqual(elapsed, budget,
+            "first gameplay frame after %.1f ms, budget %.1f ms" % (elapsed, budget))
+
+
+if __name__ == "__main__":
+    unittest.main()